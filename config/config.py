@@ -8,6 +8,15 @@ ELO_CONSTANTS = {
     "G": {"K": ELO_CONSTANTS_LIST[8], "S": ELO_CONSTANTS_LIST[9]},
 }
 
+# K and S of the surface Elo tracks by tourney level, tuned separately from the
+# overall ratings. They start out the same as ELO_CONSTANTS
+SURFACE_ELO_CONSTANTS = {
+    level: dict(constants) for level, constants in ELO_CONSTANTS.items()
+}
+
+# Weight of a player's surface Elo in their blended Elo, the rest being overall Elo
+BLENDED_ELO_SURFACE_WEIGHT = 0.5
+
 performance_labels = [
     "weeks_4",
     "weeks_8",
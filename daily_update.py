@@ -5,6 +5,8 @@ import datetime
 import time
 from scripts.twitter_bot import TwitterBot
 from scripts.database_management import delete_tourney
+from scripts.feature_store import update_features
+from scripts.player_snapshots import update_player_snapshots
 from scripts.get_data import get_rankings
 import sqlite3
 import traceback
@@ -107,6 +109,14 @@ def update():
 
     scrape_data_to_sqlite(2024, 2024, update=True, overwrite=False)
     create_elo(update=True)
+
+    # Keep the feature store current, which only computes the new matches, and
+    # snapshot the players who played since last Monday's snapshots
+    conn = sqlite3.connect("data/matches.sqlite")
+    update_features(conn)
+    update_player_snapshots(conn)
+    conn.close()
+
     predicted_matches = predict_main()
     process_and_tweet_matches(predicted_matches)
     process_and_tweet_rankings(10)
@@ -1,4 +1,5 @@
 import logging
+import os
 import sqlite3
 from datetime import datetime
 from random import random
@@ -8,7 +9,6 @@ from sklearn.inspection import permutation_importance
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from alive_progress import alive_bar
 from joblib import dump, load
 from keras import optimizers, regularizers
 from keras.layers import Dense, Dropout
@@ -16,30 +16,41 @@ from keras.models import Sequential, load_model, save_model
 from keras.callbacks import Callback
 from sklearn import preprocessing
 from sklearn.metrics import f1_score, precision_score, recall_score
-from tqdm import tqdm
 
 from config.config import STAT_LABELS
-from scripts.stats import get_all_matches_for_player, get_match_stats
+from scripts.feature_selection import ALL_FEATURES, SWAP_PERMUTATION
+from scripts.feature_store import (
+    STORABLE_FILTER,
+    TRAINING_FILTER,
+    load_features,
+    update_features,
+)
 from sklearn.feature_selection import RFE
 from sklearn.linear_model import LogisticRegression
 
 labels = STAT_LABELS
 
-swapped_labels = []
-for label in labels:
-    if "A_" in label:
-        swapped_labels.append(label.replace("A_", "B_"))
-    elif "B_" in label:
-        swapped_labels.append(label.replace("B_", "A_"))
-    else:
-        swapped_labels.append(label)
+swapped_labels = [labels[i] for i in SWAP_PERMUTATION]
+
+
+def add_swapped_rows(X_AB, Y_AB):
+    """
+    Interleave each A vs B row with its B vs A row, which is the same feature vector
+    with the player columns permuted and the opposite result.
+    """
+    X = np.empty((2 * len(X_AB), X_AB.shape[1]), dtype=X_AB.dtype)
+    X[0::2] = X_AB
+    X[1::2] = X_AB[:, SWAP_PERMUTATION]
+    Y = np.empty(2 * len(Y_AB), dtype=Y_AB.dtype)
+    Y[0::2] = Y_AB
+    Y[1::2] = 1 - Y_AB
+    return X, Y
 
 
 class MatchData:
     def __init__(self, conn, recalculate_stats):
         self.conn = conn
         self.recalculate_stats = recalculate_stats
-        self.player_match_dict = {}
         self.X = np.array([[None]])
         self.Y = np.array([[None]])
 
@@ -50,87 +61,29 @@ class MatchData:
             self.matches = self.load_from_csv("data/training_data.csv")
 
     def load_data(self):
-        query = "SELECT * FROM tennis_matches WHERE match_id >= '2000' AND tourney_level != 'F' ORDER BY match_id ASC"
+        # The same matches as the feature store computes, so every one has a row
+        query = (
+            f"SELECT * FROM tennis_matches WHERE {TRAINING_FILTER} "
+            f"AND {STORABLE_FILTER} ORDER BY match_id ASC"
+        )
         matches_df = pd.read_sql_query(query, self.conn)
         return matches_df.to_dict("records")
 
     def process_data(self):
-        excluded_levels = ["F"]
-        X_list = []  # List to hold arrays of data_list for each chunk
-        Y_list = []  # List to hold arrays of result for each chunk
-        with alive_bar(len(self.matches), title="Processing matches") as bar:
-            for m in self.matches:
-                if m["tourney_level"] in excluded_levels:
-                    bar()
-                    continue
-
-                X, Y = self.process_match(m, 1)
-                # Append chunk's data_list and result to the lists
-                X_list.append(X)
-                Y_list.append(Y)
-
-                swapped_match = copy.deepcopy(m)
-                (
-                    swapped_match["A_name"],
-                    swapped_match["B_name"],
-                    swapped_match["A_simplified_name"],
-                    swapped_match["B_simplified_name"],
-                ) = (
-                    m["B_name"],
-                    m["A_name"],
-                    m["B_simplified_name"],
-                    m["A_simplified_name"],
-                )
-
-                X, Y = self.process_match(swapped_match, 0)
-                # Append chunk's data_list and result to the lists
-                X_list.append(X)
-                Y_list.append(Y)
-
-                bar()
-
-        # Concatenate all chunk arrays into one array
-        self.X = np.array(X_list) if len(X_list) > 0 else np.array([None])
-        self.Y = np.array(Y_list) if len(Y_list) > 0 else np.array([None])
-
-    def process_match(self, m, result):
-        player_A = m["A_simplified_name"]
-        player_B = m["B_simplified_name"]
-
-        match_id = m["match_id"]
-
-        if match_id < "2000":
-            return
-
-        if player_A not in self.player_match_dict:
-            self.player_match_dict[player_A] = get_all_matches_for_player(
-                player_A, self.conn
+        # Bring the feature store up to date, computing only missing or stale matches
+        # on every core, then read every match's A vs B vector from it. The B vs A
+        # rows are permutations of those, so they are never stored
+        update_features(self.conn, workers=os.cpu_count())
+        features = load_features(self.conn, [m["match_id"] for m in self.matches])
+        X_list = [features[m["match_id"]][2] for m in self.matches]
+
+        if len(X_list) > 0:
+            self.X, self.Y = add_swapped_rows(
+                np.array(X_list), np.ones(len(X_list), dtype=int)
             )
-        if player_B not in self.player_match_dict:
-            self.player_match_dict[player_B] = get_all_matches_for_player(
-                player_B, self.conn
-            )
-
-        player_A_matches = self.player_match_dict[player_A]
-        player_B_matches = self.player_match_dict[player_B]
-
-        player_A_matches = [
-            player_A_matches[i]
-            for i in range(len(player_A_matches))
-            if player_A_matches[i]["match_id"] < match_id
-        ]
-
-        player_B_matches = [
-            player_B_matches[i]
-            for i in range(len(player_B_matches))
-            if player_B_matches[i]["match_id"] < match_id
-        ]
-
-        data_list = get_match_stats(
-            m, player_A, player_B, player_A_matches, player_B_matches
-        )
-
-        return data_list, result
+        else:
+            self.X = np.array([None])
+            self.Y = np.array([None])
 
     def load_from_csv(self, file_path, chunksize=10**6):
         X_list = []  # List to hold arrays of data_list for each chunk
@@ -138,36 +91,16 @@ class MatchData:
         matches_list = []  # List to hold each chunk
 
         for chunk in pd.read_csv(file_path, chunksize=chunksize):
-            chunk_data = []
-            chunk_results = []
             matches_list.append(chunk.to_dict("records"))
-            for index, match in tqdm(
-                chunk.iterrows(), desc="Loading matches", smoothing=0.8
-            ):
-                if match["match_id"] > "202305":
-                    continue
-
-                data_list = [match[label] for label in labels]
-                result = match["result"]
-                chunk_data.append(data_list)
-                chunk_results.append(result)
-
-                # Create new record for B vs A
-                swapped_data_list = []
-                for label in labels:
-                    if label.startswith("A_"):
-                        swapped_data_list.append(match[label.replace("A_", "B_")])
-                    elif label.startswith("B_"):
-                        swapped_data_list.append(match[label.replace("B_", "A_")])
-                    else:
-                        swapped_data_list.append(match[label])
-                swapped_result = 1 - result
-                chunk_data.append(swapped_data_list)
-                chunk_results.append(swapped_result)
+            chunk = chunk[chunk["match_id"] <= "202305"]
 
-            # Append chunk's data_list and result to the lists
-            X_list.append(np.array(chunk_data, dtype=np.float32))
-            Y_list.append(np.array(chunk_results, dtype=np.float32))
+            # Each match gives an A vs B row and its swapped B vs A row
+            chunk_data, chunk_results = add_swapped_rows(
+                chunk[labels].to_numpy(dtype=np.float32),
+                chunk["result"].to_numpy(dtype=np.float32),
+            )
+            X_list.append(chunk_data)
+            Y_list.append(chunk_results)
 
         # Concatenate all chunk arrays into one array
         self.X = np.concatenate(X_list, axis=0) if len(X_list) > 0 else np.array([None])
@@ -238,8 +171,19 @@ class CustomModelCheckpoint(Callback):
 
 
 class NeuralNet:
-    def __init__(self, match_data, num_features):
-        self.X, self.Y = match_data.X, match_data.Y
+    def __init__(self, match_data, num_features, selection=ALL_FEATURES):
+        self.match_data = match_data
+        self.selection = selection
+        self.split_data()
+
+        # Set up logging
+        logging.basicConfig(filename="training_logs.txt", level=logging.INFO)
+        logging.info("Initialized NeuralNet")
+
+    def split_data(self):
+        # The model only sees the stats in its feature selection
+        self.X = self.match_data.X[:, self.selection.indices]
+        self.Y = self.match_data.Y
 
         self.X_transformer = preprocessing.MinMaxScaler().fit(self.X)
         normal_X = self.X_transformer.transform(self.X)
@@ -254,9 +198,16 @@ class NeuralNet:
         self.Y_train = self.Y[self.train_indices]
         self.Y_test = self.Y[self.test_indices]
 
-        # Set up logging
-        logging.basicConfig(filename="training_logs.txt", level=logging.INFO)
-        logging.info("Initialized NeuralNet")
+    def select_features(self, mask):
+        """
+        Narrow the feature selection to the features in mask, such as the one returned
+        by feature_importance, and split the narrowed data again. Models created
+        afterwards take only those features, and save_model records the selection so
+        predictions only compute them.
+        """
+        self.selection = self.selection.narrow(mask)
+        self.split_data()
+        logging.info("Selected %s features", len(self.selection.labels))
 
     def create_model(
         self,
@@ -393,7 +344,7 @@ class NeuralNet:
                 )
 
         # Create feature selection mask
-        mask = [False] * len(self.X_test.columns)
+        mask = [False] * self.X_test.shape[1]
         for i in sorted_indices[:n_features]:
             mask[i] = True
 
@@ -405,17 +356,20 @@ class NeuralNet:
         plt.show()
 
     def save_model(self):
-        model_filepath = (
-            f"models/NN_model/NN_model_{datetime.now().strftime('%Y%m%d-%H%M')}.sav"
-        )
-        transformer_filepath = f"models/transformer/NN_transformer_{datetime.now().strftime('%Y%m%d-%H%M')}.sav"
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M")
+        model_filepath = f"models/NN_model/NN_model_{timestamp}.sav"
+        transformer_filepath = f"models/transformer/NN_transformer_{timestamp}.sav"
+        selection_filepath = f"models/feature_selection/NN_features_{timestamp}.json"
         save_model(self.best_model, model_filepath)
         dump(self.X_transformer, transformer_filepath)
+        os.makedirs("models/feature_selection", exist_ok=True)
+        self.selection.save(selection_filepath)
 
         logging.info(
-            "Saved model to %s and transformer to %s",
+            "Saved model to %s, transformer to %s and feature selection to %s",
             model_filepath,
             transformer_filepath,
+            selection_filepath,
         )
 
     def load_model(self, model_filepath, transformer_filepath):
@@ -487,7 +441,7 @@ def main(train=True, recalculate_stats=False):
                         if continue_training_input.lower() == "n":
                             continue_training = False
 
-                # mask = nn.feature_importance(model, 80)
+                # nn.select_features(nn.feature_importance(model, 80))
                 new_structure_input = input(
                     "Do you want to restart with a new structure? (Y/n): "
                 )
@@ -0,0 +1,607 @@
+"""
+Benchmarks and a parity check for the stats code, run on synthetic tennis_matches
+databases so they need neither the scraped data nor a network connection.
+
+    python -m scripts.benchmark_stats [10k|100k|1M]
+
+The first run of a size generates data/benchmarks/synthetic_{size}.sqlite and saves
+the outputs of stats.get_match_stats for a sample of its matches as the reference
+that later runs, and any new engine, are checked against. The reference is computed
+with the original list path, get_match_stats over lists of history rows, which gives
+the same outputs as before any engine was added.
+
+The list path must match the reference exactly. The PlayerHistory and FeatureEngine
+paths keep Elo change variances as running sums, which round differently from the
+variance of each window's list, so their variance stats may differ by
+VARIANCE_TOLERANCE relative to the reference. Every other stat must match exactly.
+"""
+
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+from alive_progress import alive_bar
+
+from config.config import STAT_LABELS
+from scripts.create_elo import calculate_elo, create_elo
+from scripts.data_helpers import count_games, get_match_day, simplify_name
+from scripts.feature_engine import FeatureEngine, iterate_matches
+from scripts.player_history import PlayerHistory
+from scripts.player_snapshots import (
+    delete_player_snapshots,
+    get_player_state,
+    update_player_snapshots,
+)
+from scripts.stats import (
+    days_since_debut,
+    get_all_matches_for_players,
+    get_elo_variance,
+    get_fatigue_scores,
+    get_h2h,
+    get_h2h_conditions,
+    get_match_stats,
+    get_peak_elo,
+    get_performance_and_record,
+    get_performance_conditions,
+    get_previous_elo,
+    get_variance_conditions,
+)
+from scripts.players import add_player_ids
+from scripts.tournaments import add_tourney_keys
+
+BENCHMARK_DIR = "data/benchmarks"
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000}
+
+# Relative difference allowed in variance stats computed from running sums. The
+# largest seen on the synthetic databases is about 6e-13
+VARIANCE_TOLERANCE = 1e-11
+VARIANCE_INDICES = {i for i, label in enumerate(STAT_LABELS) if "variance" in label}
+
+FIRST_NAMES = [
+    "Adrian", "Alex", "Andrea", "Boris", "Carlos", "Daniel", "David", "Diego",
+    "Dominik", "Emil", "Felix", "Filip", "Gael", "Hugo", "Ivan", "Jakub", "James",
+    "Jan", "Jordan", "Juan", "Kei", "Leo", "Lorenzo", "Lucas", "Marco", "Marin",
+    "Mario", "Martin", "Matteo", "Max", "Mikhail", "Nicolas", "Novak", "Oscar",
+    "Pablo", "Pedro", "Rafael", "Roberto", "Stefan", "Thomas", "Tomas", "Yannick",
+]  # fmt: skip
+LAST_NAMES = [
+    "Almagro", "Baker", "Berrettini", "Cerundolo", "Cilic", "Coria", "Davydenko",
+    "Dimitrov", "Evans", "Ferrer", "Fognini", "Fritz", "Gasquet", "Goffin", "Haas",
+    "Hurkacz", "Isner", "Karlovic", "Khachanov", "Kohlschreiber", "Kovac", "Kubot",
+    "Lopez", "Mayer", "Medina", "Monfils", "Muller", "Nishikori", "Norrie", "Paire",
+    "Querrey", "Ramos", "Rublev", "Ruud", "Schwartzman", "Simon", "Sock", "Soderling",
+    "Tipsarevic", "Troicki", "Verdasco", "Wawrinka", "Youzhny", "Zverev",
+]  # fmt: skip
+IOCS = [
+    "ARG", "AUS", "AUT", "BRA", "CAN", "CHI", "CRO", "ESP", "FRA", "GBR", "GER", "ITA",
+    "JPN", "NED", "RUS", "SRB", "SUI", "SWE", "USA",
+]  # fmt: skip
+SURFACES = ["Hard", "Hard", "Hard", "Clay", "Clay", "Grass", "Carpet"]
+
+# Tournaments of each level held in a week, and the draw size of their main draw
+LEVELS = {"G": (0, 128), "M": (0, 64), "A": (3, 32), "C": (6, 32), "F": (12, 32)}
+GRAND_SLAMS = {
+    2: ("australian-open", "Hard", "AUS"),
+    21: ("roland-garros", "Clay", "FRA"),
+    26: ("wimbledon", "Grass", "GBR"),
+    35: ("us-open", "Hard", "USA"),
+}
+MASTERS_WEEKS = [10, 12, 15, 18, 20, 31, 32, 41, 44]
+# Share of the active players, strongest first, skipped by the fields of each level
+FIELD_START = {"G": 0, "M": 0, "A": 0.05, "C": 0.2, "F": 0.4}
+MAIN_ROUNDS = ["R128", "R64", "R32", "R16", "QF", "SF", "F"]
+SET_SCORES = ["60", "61", "62", "63", "64", "75", "76"]
+
+
+def create_synthetic_table(conn):
+    conn.execute("DROP TABLE IF EXISTS tennis_matches")
+    conn.execute("""
+        CREATE TABLE tennis_matches (
+            match_id TEXT PRIMARY KEY, tourney_name TEXT, surface TEXT, round TEXT,
+            tourney_level TEXT, tourney_IOC TEXT, A_name TEXT, B_name TEXT,
+            A_serve_rating REAL, B_serve_rating REAL, score TEXT, match_day INTEGER,
+            total_games INTEGER, tourney_key INTEGER, A_elo REAL, B_elo REAL,
+            A_simplified_name TEXT, B_simplified_name TEXT, A_avg_serve_rating REAL,
+            B_avg_serve_rating REAL, A_player_id INTEGER, B_player_id INTEGER
+        )
+        """)
+    conn.commit()
+
+
+def get_players(n_players, weeks, rnd):
+    """
+    Players with a skill, a serve, and a career spanning part of the weeks simulated.
+    """
+    names = []
+    for i in range(n_players):
+        first = FIRST_NAMES[i % len(FIRST_NAMES)]
+        i //= len(FIRST_NAMES)
+        last = LAST_NAMES[i % len(LAST_NAMES)]
+        i //= len(LAST_NAMES)
+        # Middle initials keep the names of larger tables unique
+        initials = ""
+        while i:
+            initials += f"{chr(ord('A') + (i - 1) % 26)}. "
+            i = (i - 1) // 26
+        names.append(f"{first} {initials}{last}")
+    rnd.shuffle(names)
+
+    players = []
+    for name in names:
+        debut = rnd.randint(-weeks // 4, weeks - 1)
+        players.append(
+            {
+                "name": name,
+                "skill": rnd.gauss(0, 1),
+                "serve": rnd.gauss(250, 25),
+                "debut": debut,
+                "retire": debut + rnd.randint(52, 52 * 15),
+            }
+        )
+    return players
+
+
+def get_tournaments(rnd):
+    """A calendar of recurring tournaments: (level, name, surface, IOC) per week."""
+    calendar = {}
+    number = 0
+    for week in range(52):
+        calendar[week] = []
+        if week in GRAND_SLAMS:
+            calendar[week].append(("G",) + GRAND_SLAMS[week])
+        if week in MASTERS_WEEKS:
+            calendar[week].append(
+                ("M", f"masters-{week}", rnd.choice(SURFACES[:5]), rnd.choice(IOCS))
+            )
+        for level, (count, _) in LEVELS.items():
+            for _ in range(count):
+                number += 1
+                calendar[week].append(
+                    (level, f"open-{number}", rnd.choice(SURFACES), rnd.choice(IOCS))
+                )
+    return calendar
+
+
+def get_score(best_of, rnd):
+    """A score string of the winner winning best_of // 2 + 1 sets."""
+    if rnd.random() < 0.02:
+        return "W/O"
+    sets = [rnd.choice(SET_SCORES) for _ in range(best_of // 2)]
+    sets += [rnd.choice(SET_SCORES)[::-1] for _ in range(rnd.randint(0, best_of // 2))]
+    rnd.shuffle(sets)
+    # The winner takes the last set
+    return "_".join(sets + [rnd.choice(SET_SCORES)])
+
+
+def get_match_row(match_id, tournament, round_name, A, B, state, rnd):
+    """A tennis_matches row of A beating B, updating the Elo and serve totals."""
+    level, name, surface, ioc = tournament
+    elos, serve_ratings, tourney_keys = state
+    score = get_score(5 if level == "G" else 3, rnd)
+    A_elo, B_elo = calculate_elo(
+        (elos.get(A["name"], 1500), elos.get(B["name"], 1500)), level
+    )
+    elos[A["name"]], elos[B["name"]] = A_elo, B_elo
+
+    serves = []
+    for player in [A, B]:
+        rating = rnd.gauss(player["serve"], 30)
+        totals = serve_ratings.setdefault(player["name"], [0, 0])
+        totals[0] += rating
+        totals[1] += 1
+        serves.append((rating, totals[0] / totals[1]))
+
+    return (
+        match_id,
+        name,
+        surface,
+        round_name,
+        level,
+        ioc,
+        A["name"],
+        B["name"],
+        serves[0][0],
+        serves[1][0],
+        score,
+        get_match_day(match_id),
+        count_games(score),
+        tourney_keys[name],
+        float(A_elo),
+        float(B_elo),
+        simplify_name(A["name"]),
+        simplify_name(B["name"]),
+        serves[0][1],
+        serves[1][1],
+        A["player_id"],
+        B["player_id"],
+    )
+
+
+def play_draw(field, rounds, rnd):
+    """Play a knockout draw, returning (round, winner, loser) for every match."""
+    results = []
+    for round_name in rounds:
+        winners = []
+        for A, B in zip(field[0::2], field[1::2]):
+            if rnd.random() > 1 / (1 + 10 ** (B["skill"] - A["skill"])):
+                A, B = B, A
+            results.append((round_name, A, B))
+            winners.append(A)
+        field = winners
+    return results
+
+
+def generate_matches(db_path, n_matches, start_year=1990, seed=0):
+    """
+    Write a tennis_matches table of about n_matches synthetic matches to db_path, with
+    every column the stats code reads. Players have careers and a skill that decides
+    their results, tournaments recur each year at the same level, surface and country,
+    and Elo ratings are calculated as create_elo calculates them.
+
+    Smaller tables span fewer years and hold fewer, smaller tournaments each week,
+    the weekly quota of matches being filled by the biggest tournaments first.
+    """
+    rnd = random.Random(seed)
+    weeks = max(52 * 5, min(52 * 30, n_matches // 20))
+    players = get_players(max(200, n_matches // 20), weeks, rnd)
+    calendar = get_tournaments(rnd)
+    first_monday = date(start_year, 1, 1) + timedelta(
+        days=-date(start_year, 1, 1).weekday()
+    )
+    insert_query = f"INSERT INTO tennis_matches VALUES ({', '.join('?' * 22)})"
+
+    conn = sqlite3.connect(db_path)
+    create_synthetic_table(conn)
+    names = [t[1] for tournaments in calendar.values() for t in tournaments]
+    # Elo ratings, serve rating totals and tournament keys the rows are built from
+    state = {}, {}, dict(zip(names, add_tourney_keys(conn, names)))
+    player_ids = add_player_ids(conn, [player["name"] for player in players])
+    for player, player_id in zip(players, player_ids):
+        player["player_id"] = player_id
+    n_written = 0
+
+    with alive_bar(n_matches, title="Generating matches") as bar:
+        for week in range(weeks):
+            monday = first_monday + timedelta(weeks=week)
+            quota = n_matches * (week + 1) // weeks - n_written
+            # Strongest first, each player entering one tournament a week
+            available = sorted(
+                (p for p in players if p["debut"] <= week < p["retire"]),
+                key=lambda p: -p["skill"],
+            )
+
+            rows = []
+            for number, tournament in enumerate(calendar[week % 52], 1):
+                level = tournament[0]
+                pool = available[int(len(available) * FIELD_START[level]) :]
+                draw = min(LEVELS[level][1], quota + 1, len(pool))
+                if draw < 2:
+                    continue
+                draw = 2 ** (draw.bit_length() - 1)
+
+                field = rnd.sample(pool[: draw * 3], draw)
+                entered = {p["name"] for p in field}
+                available = [p for p in available if p["name"] not in entered]
+
+                results = play_draw(field, MAIN_ROUNDS[-draw.bit_length() + 1 :], rnd)
+                for match_number, (round_name, A, B) in enumerate(results, 1):
+                    rows.append(
+                        get_match_row(
+                            f"{monday:%Y%m%d}_{number:04d}_{match_number:03d}",
+                            tournament,
+                            round_name,
+                            A,
+                            B,
+                            state,
+                            rnd,
+                        )
+                    )
+                quota -= len(results)
+
+            conn.executemany(insert_query, rows)
+            n_written += len(rows)
+            bar(len(rows))
+
+    conn.commit()
+    conn.close()
+
+    return n_written
+
+
+def get_synthetic_db(size):
+    """Path of the synthetic database of a size in SIZES, generating it if missing."""
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    db_path = os.path.join(BENCHMARK_DIR, f"synthetic_{size}.sqlite")
+    if not os.path.exists(db_path):
+        generate_matches(db_path, SIZES[size])
+    return db_path
+
+
+def sample_matches(conn, n, seed=0):
+    """n matches drawn from the later half of the table, where histories are long."""
+    match_ids = [row[0] for row in conn.execute("SELECT match_id FROM tennis_matches")]
+    match_ids = sorted(match_ids)[len(match_ids) // 2 :]
+    sample = sorted(random.Random(seed).sample(match_ids, min(n, len(match_ids))))
+    return [
+        m
+        for i in range(0, len(sample), 500)
+        for m in iterate_matches(
+            conn,
+            "SELECT * FROM tennis_matches WHERE match_id IN "
+            f"({', '.join('?' * len(sample[i : i + 500]))}) ORDER BY match_id",
+            sample[i : i + 500],
+        )
+    ]
+
+
+def load_histories(conn, matches):
+    """{player name: every match of theirs} for the players of matches."""
+    return get_all_matches_for_players(
+        [m[f"{side}_simplified_name"] for m in matches for side in "AB"], conn
+    )
+
+
+def before(history, match_id):
+    """The matches of a history before match_id, as get_match_stats expects them."""
+    return [m for m in history if m["match_id"] < match_id]
+
+
+def get_reference_stats(conn, matches):
+    """
+    {match_id: (A vs B vector, B vs A vector)} from stats.get_match_stats, the outputs
+    any other engine is checked against.
+    """
+    histories = load_histories(conn, matches)
+    reference = {}
+    for m in matches:
+        player_A, player_B = m["A_simplified_name"], m["B_simplified_name"]
+        A_matches = before(histories[player_A], m["match_id"])
+        B_matches = before(histories[player_B], m["match_id"])
+        reference[m["match_id"]] = (
+            get_match_stats(m, player_A, player_B, A_matches, B_matches),
+            get_match_stats(m, player_B, player_A, B_matches, A_matches),
+        )
+    return reference
+
+
+def get_history_stats(conn, matches):
+    """The reference outputs computed from PlayerHistory columns, as the store does."""
+    histories = {
+        player_name: PlayerHistory.from_matches(player_name, history)
+        for player_name, history in load_histories(conn, matches).items()
+    }
+    outputs = {}
+    for m in matches:
+        player_A, player_B = m["A_simplified_name"], m["B_simplified_name"]
+        A_matches = histories[player_A].before(m["match_id"])
+        B_matches = histories[player_B].before(m["match_id"])
+        outputs[m["match_id"]] = (
+            get_match_stats(m, player_A, player_B, A_matches, B_matches),
+            get_match_stats(m, player_B, player_A, B_matches, A_matches),
+        )
+    return outputs
+
+
+def get_engine_stats(conn, matches):
+    """The reference outputs computed by replaying the table through a FeatureEngine."""
+    wanted = {m["match_id"] for m in matches}
+    engine = FeatureEngine()
+    outputs = {}
+    for m in iterate_matches(conn):
+        if m["match_id"] in wanted:
+            outputs[m["match_id"]] = (
+                engine.get_match_stats(m),
+                engine.get_match_stats(
+                    m, m["B_simplified_name"], m["A_simplified_name"]
+                ),
+            )
+        engine.update(m)
+    return outputs
+
+
+def find_mismatches(reference, outputs, tolerance=0):
+    """
+    Return (match_id, index, expected, got) for every stat of outputs that differs from
+    reference in value or type. With a tolerance, variance stats may differ by that
+    much relative to the expected value, for engines that keep them as running sums.
+    """
+    mismatches = []
+    for match_id, expected_vectors in reference.items():
+        got_vectors = outputs.get(match_id)
+        if got_vectors is None:
+            mismatches.append((match_id, None, expected_vectors, None))
+            continue
+        for expected_vector, got_vector in zip(expected_vectors, got_vectors):
+            if len(expected_vector) != len(got_vector):
+                mismatches.append((match_id, None, expected_vector, got_vector))
+                continue
+            for i, (expected, got) in enumerate(zip(expected_vector, got_vector)):
+                if type(expected) is not type(got):
+                    mismatches.append((match_id, i, expected, got))
+                elif expected != got and not (
+                    tolerance
+                    and i in VARIANCE_INDICES
+                    and isinstance(expected, float)
+                    and abs(expected - got) <= tolerance * max(1, abs(expected))
+                ):
+                    mismatches.append((match_id, i, expected, got))
+    return mismatches
+
+
+def assert_parity(reference, outputs, tolerance=0):
+    """Raise an AssertionError naming the first stats of outputs that differ."""
+    mismatches = find_mismatches(reference, outputs, tolerance)
+    assert (
+        not mismatches
+    ), f"{len(mismatches)} stats differ from the reference, first: " + ", ".join(
+        f"{match_id}[{i}] expected {expected!r} got {got!r}"
+        for match_id, i, expected, got in mismatches[:5]
+    )
+
+
+def load_reference(conn, reference_path, n):
+    """
+    Load the reference outputs saved at reference_path, saving them from the list path
+    of stats.get_match_stats for n sampled matches first if there are none.
+    """
+    if not os.path.exists(reference_path):
+        reference = get_reference_stats(conn, sample_matches(conn, n))
+        with open(reference_path, "wb") as f:
+            pickle.dump(reference, f)
+    with open(reference_path, "rb") as f:
+        return pickle.load(f)
+
+
+def check_snapshot_invalidation(db_path, n_runs=12):
+    """
+    Snapshot a copy of the database at n_runs dates through its history, invalidate
+    from the middle of it and snapshot again, then assert that every player's state
+    matches a rebuild from their first match. With more runs than the snapshots kept
+    per player, some players lose every snapshot to the invalidation.
+    """
+    copy_path = os.path.join(BENCHMARK_DIR, "snapshots.sqlite")
+    shutil.copyfile(db_path, copy_path)
+    conn = sqlite3.connect(copy_path)
+    reference_conn = sqlite3.connect(db_path)
+
+    match_ids = sorted(
+        row[0] for row in conn.execute("SELECT match_id FROM tennis_matches")
+    )
+    for i in range(1, n_runs + 1):
+        update_player_snapshots(conn, match_ids[len(match_ids) * i // (n_runs + 1)][:8])
+    delete_player_snapshots(conn, match_ids[len(match_ids) // 2])
+    update_player_snapshots(conn, "99991231")
+
+    player_names = [
+        row[0]
+        for row in conn.execute(
+            "SELECT A_simplified_name FROM tennis_matches "
+            "UNION SELECT B_simplified_name FROM tennis_matches"
+        )
+    ]
+    differing = [
+        player_name
+        for player_name in player_names
+        if get_player_state(conn, player_name).__getstate__()
+        != get_player_state(reference_conn, player_name).__getstate__()
+    ]
+    conn.close()
+    reference_conn.close()
+    os.remove(copy_path)
+    assert not differing, (
+        f"{len(differing)} of {len(player_names)} player snapshots differ from a "
+        f"rebuild after invalidation, first: {', '.join(differing[:5])}"
+    )
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def get_family_timings(matches, histories):
+    """Seconds spent on each stat family over matches, both players per match."""
+    families = {
+        "previous_elo": lambda m, p, h: get_previous_elo(p, m["match_id"], h),
+        "peak_elo": lambda m, p, h: get_peak_elo(p, m["match_id"], h),
+        "days_since_debut": lambda m, p, h: days_since_debut(p, m["match_id"], h),
+        "fatigue": lambda m, p, h: get_fatigue_scores(p, m["match_id"], h),
+        "variance": lambda m, p, h: get_elo_variance(
+            p, m["match_id"], h, get_variance_conditions(m)
+        ),
+        "performance": lambda m, p, h: get_performance_and_record(
+            p, m["match_id"], h, get_performance_conditions(m)
+        ),
+        "h2h": lambda m, p, h: get_h2h(
+            [p, m["B_simplified_name"]], m["match_id"], h, get_h2h_conditions(m)
+        ),
+    }
+    player_histories = [
+        (m, player_name, before(histories[player_name], m["match_id"]))
+        for m in matches
+        for player_name in [m["A_simplified_name"], m["B_simplified_name"]]
+    ]
+
+    timings = {}
+    for family, function in families.items():
+        start = time.perf_counter()
+        for m, player_name, history in player_histories:
+            function(m, player_name, history)
+        timings[family] = time.perf_counter() - start
+    return timings
+
+
+def get_fixtures(matches):
+    """A predictions sheet of matches, as predict.load_data reads it."""
+    df = pd.DataFrame(matches)
+    df["p"] = None
+    return df
+
+
+def run_benchmarks(size="10k", n=1000, tolerance=VARIANCE_TOLERANCE):
+    """
+    Time the stats code on the synthetic database of a size and check every engine
+    against the reference outputs. Returns {benchmark: (matches, seconds)}.
+    """
+    db_path = get_synthetic_db(size)
+    conn = sqlite3.connect(db_path)
+    n_matches = conn.execute("SELECT COUNT(*) FROM tennis_matches").fetchone()[0]
+    reference = load_reference(
+        conn, os.path.join(BENCHMARK_DIR, f"reference_{size}.pkl"), n
+    )
+    matches = sample_matches(conn, n)
+
+    results = {}
+    histories, seconds = time_call(load_histories, conn, matches)
+    results["load histories"] = (len(matches), seconds)
+
+    outputs, seconds = time_call(get_reference_stats, conn, matches)
+    results["get_match_stats"] = (len(matches), seconds)
+    assert_parity(reference, outputs)
+
+    for family, seconds in get_family_timings(matches, histories).items():
+        results[f"  {family}"] = (len(matches), seconds)
+
+    outputs, seconds = time_call(get_history_stats, conn, matches)
+    results["get_match_stats (PlayerHistory)"] = (len(matches), seconds)
+    assert_parity(reference, outputs, tolerance)
+
+    outputs, seconds = time_call(get_engine_stats, conn, matches)
+    results["FeatureEngine replay"] = (n_matches, seconds)
+    assert_parity(reference, outputs, tolerance)
+
+    check_snapshot_invalidation(db_path)
+
+    copy_path = os.path.join(BENCHMARK_DIR, f"create_elo_{size}.sqlite")
+    shutil.copyfile(db_path, copy_path)
+    _, seconds = time_call(create_elo, False, copy_path)
+    results["create_elo"] = (n_matches, seconds)
+    os.remove(copy_path)
+
+    try:
+        from scripts.predict import prepare_data
+    except ImportError as e:
+        print(f"Skipping predict.prepare_data: {e}")
+    else:
+        _, seconds = time_call(prepare_data, get_fixtures(matches), conn)
+        results["predict.prepare_data"] = (len(matches), seconds)
+
+    conn.close()
+
+    print(f"\n{size} synthetic matches, {len(matches)} sampled")
+    for name, (count, seconds) in results.items():
+        print(f"{name:<34} {seconds:>9.2f}s {count / seconds:>12.1f} matches/s")
+
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmarks(sys.argv[1] if len(sys.argv) > 1 else "10k")
@@ -0,0 +1,134 @@
+from functools import lru_cache
+
+from scripts.data_helpers import get_day, get_match_day, get_window_start, simplify_name
+
+# Condition keys and the tennis_matches columns they are compared with
+CONDITION_COLUMNS = {
+    "surface": "surface",
+    "IOC": "tourney_IOC",
+    "tourney_name": "tourney_name",
+    "tourney_key": "tourney_key",
+    "round": "round",
+    "tourney_level": "tourney_level",
+}
+
+
+def get_condition_value(key, value):
+    if key == "tourney_name" and value is not None:
+        return simplify_name(value)
+    return value
+
+
+class ConditionPlan:
+    """
+    A list of condition dictionaries compiled into shared filters.
+
+    Every distinct (key, value) filter and every distinct weeks window is an atom,
+    evaluated once per match, or once per history as a mask, and shared by all the
+    conditions that use it. Each condition is then the AND of its atoms. Keys without
+    a value are ignored, as are keys that are not condition keys.
+
+    Attributes:
+    atoms (list): Distinct (key, value) filters, with tourney names simplified.
+    weeks (list): Distinct weeks windows.
+    conditions (list): (index into weeks or None, tuple of indices into atoms) for
+                       each condition, in order.
+    specs (list): (weeks or None, sorted tuple of (key, value) filters) for each
+                  condition, in order.
+    """
+
+    def __init__(self, conditions_list):
+        self.atoms = []
+        self.weeks = []
+        self.conditions = []
+        self.specs = []
+
+        atom_index = {}
+        weeks_index = {}
+        for condition in conditions_list:
+            weeks = condition.get("weeks")
+            if weeks is not None and weeks not in weeks_index:
+                weeks_index[weeks] = len(self.weeks)
+                self.weeks.append(weeks)
+
+            items = sorted(
+                (key, get_condition_value(key, value))
+                for key, value in condition.items()
+                if key in CONDITION_COLUMNS and value is not None
+            )
+            for item in items:
+                if item not in atom_index:
+                    atom_index[item] = len(self.atoms)
+                    self.atoms.append(item)
+
+            self.conditions.append(
+                (
+                    weeks_index[weeks] if weeks is not None else None,
+                    tuple(atom_index[item] for item in items),
+                )
+            )
+            self.specs.append((weeks, tuple(items)))
+
+        self.uses_tourney_name = any(key == "tourney_name" for key, _ in self.atoms)
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def get_window_starts(self, match_id):
+        """First day ordinal of each weeks window ending at match_id."""
+        if not self.weeks:
+            return []
+        day = get_match_day(match_id)
+        return [get_window_start(day, weeks) for weeks in self.weeks]
+
+    def evaluate(self, match, match_id, window_starts):
+        """
+        Whether a match dictionary satisfies each condition, as a list of booleans.
+        Matches inside a weeks window must also come before match_id.
+        """
+        if window_starts:
+            day = get_day(match)
+            before = match["match_id"] < match_id
+            in_window = [before and day >= start for start in window_starts]
+        tourney_name = (
+            simplify_name(match["tourney_name"]) if self.uses_tourney_name else None
+        )
+
+        atoms = [
+            (tourney_name if key == "tourney_name" else match[CONDITION_COLUMNS[key]])
+            == value
+            for key, value in self.atoms
+        ]
+
+        return [
+            (weeks is None or in_window[weeks]) and all(atoms[i] for i in indices)
+            for weeks, indices in self.conditions
+        ]
+
+    def filter(self, matches, match_id):
+        """
+        The matches satisfying each condition, as one list per condition in the order
+        of the input.
+        """
+        window_starts = self.get_window_starts(match_id)
+        filtered = [[] for _ in self.conditions]
+        for match in matches:
+            for i, satisfied in enumerate(
+                self.evaluate(match, match_id, window_starts)
+            ):
+                if satisfied:
+                    filtered[i].append(match)
+        return filtered
+
+
+def compile_conditions(conditions_list):
+    """
+    Compile a list of condition dictionaries into a ConditionPlan. Plans are cached, so
+    the condition lists built for every match only compile once per distinct list.
+    """
+    return get_plan(tuple(tuple(condition.items()) for condition in conditions_list))
+
+
+@lru_cache(maxsize=4096)
+def get_plan(conditions_key):
+    return ConditionPlan([dict(condition) for condition in conditions_key])
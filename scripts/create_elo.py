@@ -3,11 +3,32 @@ import pandas as pd
 from numpy import power
 from config.config import ELO_CONSTANTS_LIST
 from alive_progress import alive_bar
-from scripts.stats import get_previous_elo, get_all_matches_for_player
-from scripts.data_helpers import simplify_name
+from scripts.elo_engine import (
+    ELO_COLUMNS,
+    EloEngine,
+    clear_elo_dirty,
+    delete_elo_checkpoints,
+    get_elo_dirty,
+    get_level_codes,
+    get_rated_to,
+    get_surface_codes,
+    load_elo_checkpoint,
+    load_player_ratings,
+    mark_elo_dirty,
+    save_elo_checkpoint,
+    write_player_ratings,
+)
+from scripts.data_helpers import count_games, get_match_day, simplify_name
+from scripts.feature_store import invalidate_features
+from scripts.match_changes import log_match_change
+from scripts.players import add_player_ids
+from scripts.tournaments import add_tourney_keys
 
 v = ELO_CONSTANTS_LIST
 
+# Rating checkpoints are stored at the start of each year of match ids
+CHECKPOINT_PREFIX_LENGTH = 4
+
 
 def calculate_elo(row, tourney_level):
     k_s = {
@@ -30,8 +51,8 @@ def calculate_elo(row, tourney_level):
     return A_new_elo, B_new_elo
 
 
-def create_elo(update=True):
-    conn = sqlite3.connect("data/matches.sqlite")
+def create_elo(update=True, db_path="data/matches.sqlite"):
+    conn = sqlite3.connect(db_path)
 
     # Check if A_elo and B_elo columns already exist
     column_query = "PRAGMA table_info(tennis_matches);"
@@ -50,80 +71,198 @@ def create_elo(update=True):
     if "B_simplified_name" not in existing_columns:
         conn.execute("ALTER TABLE tennis_matches ADD COLUMN B_simplified_name TEXT;")
 
-    query = "SELECT * FROM tennis_matches"
+    # Integer day and games count of each match, so date windows and fatigue can be
+    # computed without parsing ids and scores
+    if "match_day" not in existing_columns:
+        conn.execute("ALTER TABLE tennis_matches ADD COLUMN match_day INTEGER;")
+    if "total_games" not in existing_columns:
+        conn.execute("ALTER TABLE tennis_matches ADD COLUMN total_games INTEGER;")
+    # Key of the match's tournament in the tournaments table, so tournaments can be
+    # compared as integers rather than by simplifying their names
+    if "tourney_key" not in existing_columns:
+        conn.execute("ALTER TABLE tennis_matches ADD COLUMN tourney_key INTEGER;")
+    # Integer ids of the players in the players table, so players can be keyed and
+    # compared as integers rather than by name
+    if "A_player_id" not in existing_columns:
+        conn.execute("ALTER TABLE tennis_matches ADD COLUMN A_player_id INTEGER;")
+    if "B_player_id" not in existing_columns:
+        conn.execute("ALTER TABLE tennis_matches ADD COLUMN B_player_id INTEGER;")
+    conn.commit()
+
+    # Surface and blended ratings, replayed with the overall ratings. Matches rated
+    # before the columns existed need them too, so every match is made dirty
+    new_rating_columns = [c for c in ELO_COLUMNS[2:] if c not in existing_columns]
+    for column in new_rating_columns:
+        conn.execute(f"ALTER TABLE tennis_matches ADD COLUMN {column} REAL;")
+    conn.commit()
+    if new_rating_columns:
+        mark_elo_dirty(conn, "")
+
+    # Features of later matches were computed from the old names and ids
+    derived_from = fill_match_columns(conn, recompute=not update)
+    if derived_from is not None:
+        invalidate_features(conn, derived_from)
 
+    # Ratings are replayed from the newest checkpoint before the earliest dirty match,
+    # so a back-filled tournament only costs the matches played since. When every
+    # dirty match is newer than all the rated ones, the current ratings are the start
     if update:
-        query += " WHERE A_elo IS NULL OR B_elo IS NULL"
+        dirty_from = get_elo_dirty(conn)
+        if dirty_from is None:
+            conn.close()
+            return
+        rated_to = get_rated_to(conn)
+        if rated_to is not None and rated_to < dirty_from:
+            engine, replay_from = load_player_ratings(conn), dirty_from
+        else:
+            engine, replay_from = load_elo_checkpoint(conn, dirty_from)
+    else:
+        engine, replay_from = EloEngine(), ""
+    delete_elo_checkpoints(conn, replay_from)
 
-    query += " ORDER BY match_id ASC"
+    matches = conn.execute(
+        "SELECT match_id, A_player_id, B_player_id, tourney_level, surface, "
+        f"{', '.join(ELO_COLUMNS)} FROM tennis_matches "
+        "WHERE match_id >= ? ORDER BY match_id ASC",
+        (replay_from,),
+    ).fetchall()
 
-    matches_df = pd.read_sql_query(query, conn)
-    matches_df["A_simplified_name"] = matches_df["A_name"].apply(simplify_name)
-    matches_df["B_simplified_name"] = matches_df["B_name"].apply(simplify_name)
+    # One checkpoint at the start of each year, after the one replayed from
+    ratings = []
+    start = 0
+    while start < len(matches):
+        year = matches[start][0][:CHECKPOINT_PREFIX_LENGTH]
+        if year > replay_from:
+            save_elo_checkpoint(conn, year, engine)
+        end = start
+        while end < len(matches) and matches[end][0].startswith(year):
+            end += 1
+        year_matches = matches[start:end]
+        ratings += engine.replay(
+            [m[0] for m in year_matches],
+            [m[1] for m in year_matches],
+            [m[2] for m in year_matches],
+            get_level_codes([m[3] for m in year_matches]),
+            get_surface_codes([m[4] for m in year_matches]),
+        )
+        start = end
 
-    player_elo_dict = {}
-    update_queries = []
+    # Only the rows whose ratings changed are written back
+    changed_ratings = [
+        (m[0],) + match_ratings
+        for m, match_ratings in zip(matches, ratings)
+        if match_ratings != m[5:]
+    ]
+    write_match_ratings(conn, changed_ratings)
+    write_player_ratings(conn, engine)
+    clear_elo_dirty(conn)
+    conn.commit()
 
-    with alive_bar(len(matches_df)) as bar:
-        for index, row in matches_df.iterrows():
-            player_A_name, player_B_name = (
-                row["A_simplified_name"],
-                row["B_simplified_name"],
-            )
+    if changed_ratings:
+        # Features of later matches were computed from the old ratings. Full and
+        # incremental replays give the same ratings, so a full rebuild that changes
+        # nothing keeps every stored feature
+        invalidate_features(conn, changed_ratings[0][0])
 
-            match_id = row["match_id"]
+    conn.close()
 
-            if update:
-                A_previous_elo = player_elo_dict.get(player_A_name, None)
-                B_previous_elo = player_elo_dict.get(player_B_name, None)
 
-                if A_previous_elo is None:
-                    player_A_matches = get_all_matches_for_player(player_A_name, conn)
-                    A_previous_elo = get_previous_elo(
-                        player_A_name, match_id, player_A_matches
-                    )
-                    player_elo_dict[player_A_name] = A_previous_elo
+def write_match_ratings(conn, ratings):
+    """
+    Write rows of a match_id and its ELO_COLUMNS to tennis_matches. The rows are staged
+    in a temporary table with one INSERT and applied with a single UPDATE ... FROM join,
+    rather than an UPDATE per match. Nothing is committed, so the ratings are written
+    in the caller's transaction. The staged table has no index, as the join looks each
+    staged match up in tennis_matches by its match_id index.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.staged_elo")
+    conn.execute(
+        "CREATE TEMP TABLE staged_elo (match_id TEXT NOT NULL, "
+        f"{', '.join(f'{column} REAL' for column in ELO_COLUMNS)})"
+    )
 
-                if B_previous_elo is None:
-                    player_B_matches = get_all_matches_for_player(player_B_name, conn)
-                    B_previous_elo = get_previous_elo(
-                        player_B_name, match_id, player_B_matches
-                    )
-                    player_elo_dict[player_B_name] = B_previous_elo
+    with alive_bar(len(ratings), title="Staging Elo ratings") as bar:
 
-            else:
-                A_previous_elo = player_elo_dict.get(player_A_name, 1500)
-                B_previous_elo = player_elo_dict.get(player_B_name, 1500)
+        def staged_rows():
+            for i in range(0, len(ratings), 10000):
+                chunk = ratings[i : i + 10000]
+                yield from chunk
+                bar(len(chunk))
 
-            A_new_elo, B_new_elo = calculate_elo(
-                (A_previous_elo, B_previous_elo),
-                row["tourney_level"],
-            )
+        conn.executemany(
+            f"INSERT INTO staged_elo VALUES ({', '.join(['?'] * (len(ELO_COLUMNS) + 1))})",
+            staged_rows(),
+        )
 
-            matches_df.at[index, "A_elo"] = A_new_elo
-            matches_df.at[index, "B_elo"] = B_new_elo
+    set_columns = ", ".join(f"{column} = staged_elo.{column}" for column in ELO_COLUMNS)
+    cursor = conn.execute(f"""
+        UPDATE tennis_matches
+        SET {set_columns}
+        FROM staged_elo
+        WHERE tennis_matches.match_id = staged_elo.match_id
+        """)
+    print(f"Wrote the Elo ratings of {cursor.rowcount} matches.")
+    conn.execute("DROP TABLE temp.staged_elo")
 
-            update_queries.append(
-                (A_new_elo, B_new_elo, player_A_name, player_B_name, row["match_id"])
-            )
-            player_elo_dict[player_A_name] = A_new_elo
-            player_elo_dict[player_B_name] = B_new_elo
 
-            # print(f"{player_A_name}: {A_previous_elo} -> {A_new_elo}")
-            # print(f"{player_B_name}: {B_previous_elo} -> {B_new_elo}")
+def fill_match_columns(conn, recompute=False):
+    """
+    Fill the columns derived from each match's own values: the simplified names, day,
+    games count, tourney_key and player ids. Only rows missing one of them are filled,
+    unless recompute is set, when every row is computed again and the rows whose values
+    changed are rewritten.
 
-            bar()
+    Returns the earliest match_id whose values changed, or None if none did.
+    """
+    derived_columns = [
+        "A_simplified_name",
+        "B_simplified_name",
+        "match_day",
+        "total_games",
+        "tourney_key",
+        "A_player_id",
+        "B_player_id",
+    ]
+    query = (
+        "SELECT match_id, A_name, B_name, score, tourney_name, "
+        f"{', '.join(derived_columns)} FROM tennis_matches"
+    )
+    if not recompute:
+        query += " WHERE " + " OR ".join(f"{c} IS NULL" for c in derived_columns)
+    rows = conn.execute(query).fetchall()
 
-    if update and update_queries:
-        conn.executemany(
-            "UPDATE tennis_matches SET A_elo = ?, B_elo = ?, A_simplified_name = ?, B_simplified_name = ? WHERE match_id = ?;",
-            update_queries,
-        )
-        conn.commit()
-    if not update:
-        matches_df.to_sql("tennis_matches", conn, if_exists="replace", index=False)
+    # Matches share dates and scores, so each distinct one is only parsed once
+    match_days = {row[0][:8]: None for row in rows}
+    match_days = {prefix: get_match_day(prefix) for prefix in match_days}
+    games = {score: count_games(score) for score in {row[3] for row in rows}}
 
-    conn.close()
+    values = zip(
+        [simplify_name(row[1]) for row in rows],
+        [simplify_name(row[2]) for row in rows],
+        [match_days[row[0][:8]] for row in rows],
+        [games[row[3]] for row in rows],
+        add_tourney_keys(conn, [row[4] for row in rows]),
+        add_player_ids(conn, [row[1] for row in rows]),
+        add_player_ids(conn, [row[2] for row in rows]),
+    )
+    changed_rows = [
+        new_values + (row[0],)
+        for row, new_values in zip(rows, values)
+        if new_values != row[5:]
+    ]
+    conn.executemany(
+        f"UPDATE tennis_matches SET {' = ?, '.join(derived_columns)} = ? "
+        "WHERE match_id = ?;",
+        changed_rows,
+    )
+    conn.commit()
+
+    if changed_rows:
+        # Head-to-head indexes read the simplified names and ids of meetings
+        first_match_id = min(row[-1] for row in changed_rows)
+        log_match_change(conn, first_match_id)
+        return first_match_id
+    return None
 
 
 if __name__ == "__main__":
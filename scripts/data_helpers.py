@@ -1,6 +1,6 @@
 import csv
 import json
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import re
 from functools import lru_cache
 import requests
@@ -114,12 +114,89 @@ def create_player_info(bp):
     return pi
 
 
-@lru_cache(maxsize=None)
+# First day ordinal whose strftime("%Y") has four digits
+FIRST_PADDED_DAY = date(1000, 1, 1).toordinal()
+
+
+@lru_cache(maxsize=65536)
 def simplify_name(name):
     simplified_name = re.sub(r"[^A-Za-z0-9]+", "", name)
     return simplified_name.lower()
 
 
+def get_match_day(match_id):
+    """Convert the date prefix of a match id to a proleptic Gregorian day ordinal,
+    or return today's ordinal if there is no match id"""
+    if not match_id:
+        return datetime.now().toordinal()
+    return datetime.strptime(match_id[:8], "%Y%m%d").toordinal()
+
+
+def get_day(match):
+    """Return the day ordinal of a match, read from its match_day column when filled"""
+    day = match.get("match_day")
+    if day is None:
+        return get_match_day(match["match_id"])
+    return day
+
+
+def get_window_start(day, weeks):
+    """Return the first day ordinal inside a window of weeks ending on day"""
+    window_start = day - weeks * 7
+    if window_start >= FIRST_PADDED_DAY:
+        return window_start
+    return get_unpadded_window_start(day, weeks)
+
+
+@lru_cache(maxsize=1024)
+def get_unpadded_window_start(day, weeks):
+    """Windows used to be found by comparing match ids with the strftime of the window
+    start, so a window reaching back before the year 1000 (e.g. weeks=99999) compares
+    with an unpadded year. This keeps those windows covering the same matches."""
+    window_start = day - weeks * 7
+    prior_date_string = date.fromordinal(window_start).strftime("%Y%m%d")
+    if date.fromordinal(day).strftime("%Y%m%d") > prior_date_string:
+        return window_start
+    return day + 1
+
+
+def count_games(score):
+    """Count the games played in a score string, ignoring tiebreak scores"""
+    if not score:
+        return 0
+
+    if "_" not in score:
+        scores = score
+    else:
+        scores = score.split("_")
+
+    return sum(
+        (sum(int(score[i]) for i in range(min(len(score), 2)) if score[i].isdigit()))
+        for score in scores
+    )
+
+
+def get_games(match):
+    """Return the games played in a match, read from its total_games column when filled"""
+    games = match.get("total_games")
+    if games is None:
+        return count_games(match.get("score"))
+    return games
+
+
+def add_to_variance(totals, value):
+    """Add a value to running [count, mean, M2] totals in place (Welford's method)"""
+    totals[0] += 1
+    delta = value - totals[1]
+    totals[1] += delta / totals[0]
+    totals[2] += delta * (value - totals[1])
+
+
+def get_variance(count, m2):
+    """Population variance from running totals, or 0 for fewer than two values"""
+    return m2 / count if count > 1 else 0
+
+
 def get_ioc_code(location):
     """Returns the IOC code of a location, if it exists.
     If it doesn't exist, returns None."""
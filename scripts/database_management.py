@@ -5,6 +5,13 @@ import openpyxl
 import pandas as pd
 from alive_progress import alive_bar
 
+from scripts.data_helpers import count_games, get_match_day
+from scripts.elo_engine import mark_elo_dirty
+from scripts.feature_store import invalidate_features
+from scripts.match_changes import log_match_change
+from scripts.players import add_player_ids
+from scripts.tournaments import add_tourney_keys
+
 database_lock = False
 
 
@@ -95,9 +102,35 @@ def write_to_db(c, conn, match_list, overwrite=True):
             conn.commit()
 
     new_data = pd.DataFrame(match_list)
+    # Every scraped match may already be stored, leaving no columns to derive from
+    if new_data.empty:
+        print(f"Database updated with data from {len(match_list)} matches.")
+        return
+
+    new_data["match_day"] = new_data["match_id"].apply(get_match_day)
+    if "score" in new_data.columns:
+        new_data["total_games"] = new_data["score"].apply(count_games)
+    if "tourney_name" in new_data.columns:
+        new_data["tourney_key"] = add_tourney_keys(conn, new_data["tourney_name"])
+    for side in ["A", "B"]:
+        if f"{side}_name" in new_data.columns:
+            new_data[f"{side}_player_id"] = add_player_ids(
+                conn, new_data[f"{side}_name"]
+            )
     existing_columns = get_column_names(c, "tennis_matches")
 
     print("Writing new data to the database.")
+    for key in [
+        "match_day",
+        "total_games",
+        "tourney_key",
+        "A_player_id",
+        "B_player_id",
+    ]:
+        if key in new_data.columns and key not in existing_columns:
+            c.execute(f"ALTER TABLE tennis_matches ADD COLUMN {key} INTEGER")
+            conn.commit()
+            existing_columns.append(key)
     for key in new_data.columns:
         if key not in existing_columns:
             c.execute(f"ALTER TABLE tennis_matches ADD COLUMN {key} TEXT")
@@ -105,14 +138,31 @@ def write_to_db(c, conn, match_list, overwrite=True):
 
     new_data.to_sql("tennis_matches", conn, if_exists="append", index=False)
 
+    mark_matches_changed(conn, new_data["match_id"].min())
+
     print(f"Database updated with data from {len(match_list)} matches.")
 
 
 # temp function to delete all matches with match_id like '20240123'
 def delete_tourney(c, conn, year, tourney_id):
-    query = f"DELETE FROM tennis_matches WHERE match_id LIKE '{year}%{tourney_id}%'"
-    c.execute(query)
+    condition = f"match_id LIKE '{year}%{tourney_id}%'"
+    first_match_id = c.execute(
+        f"SELECT MIN(match_id) FROM tennis_matches WHERE {condition}"
+    ).fetchone()[0]
+    c.execute(f"DELETE FROM tennis_matches WHERE {condition}")
     conn.commit()
+    if first_match_id is not None:
+        mark_matches_changed(conn, first_match_id)
+
+
+def mark_matches_changed(conn, from_match_id):
+    """
+    Stored features, Elo ratings and head-to-head indexes of matches from
+    from_match_id on no longer see every match before them, so invalidate them.
+    """
+    invalidate_features(conn, from_match_id)
+    mark_elo_dirty(conn, from_match_id)
+    log_match_change(conn, from_match_id)
 
 
 def write_to_pd(fixture_list):
@@ -0,0 +1,363 @@
+import pickle
+import zlib
+
+from numpy import power
+
+from config.config import (
+    BLENDED_ELO_SURFACE_WEIGHT,
+    ELO_CONSTANTS,
+    SURFACE_ELO_CONSTANTS,
+)
+
+# Integer codes of the tourney levels, indexing LEVEL_K and LEVEL_S. Matches of any
+# other level use the ATP constants, as create_elo.calculate_elo does
+LEVELS = ["F", "C", "A", "M", "G"]
+LEVEL_CODES = {level: code for code, level in enumerate(LEVELS)}
+DEFAULT_LEVEL_CODE = LEVEL_CODES["A"]
+
+LEVEL_K = [ELO_CONSTANTS[level]["K"] for level in LEVELS]
+LEVEL_S = [ELO_CONSTANTS[level]["S"] for level in LEVELS]
+
+# Integer codes of the surfaces with their own rating track, indexing the engine's
+# surface_ratings. Matches on any other surface only change the overall ratings
+SURFACES = ["Hard", "Clay", "Grass", "Carpet"]
+SURFACE_CODES = {surface: code for code, surface in enumerate(SURFACES)}
+
+SURFACE_K = [SURFACE_ELO_CONSTANTS[level]["K"] for level in LEVELS]
+SURFACE_S = [SURFACE_ELO_CONSTANTS[level]["S"] for level in LEVELS]
+
+# Rating columns of tennis_matches, in the order of the tuples returned by replay
+ELO_COLUMNS = [
+    "A_elo",
+    "B_elo",
+    "A_surface_elo",
+    "B_surface_elo",
+    "A_blended_elo",
+    "B_blended_elo",
+]
+
+# Columns of player_ratings with each player's current rating on each surface
+SURFACE_RATING_COLUMNS = [f"{surface.lower()}_elo" for surface in SURFACES]
+
+# Bump whenever the engine's state changes, so older checkpoints are not loaded
+ELO_STATE_VERSION = 2
+
+
+def get_level_codes(levels):
+    return [LEVEL_CODES.get(level, DEFAULT_LEVEL_CODE) for level in levels]
+
+
+def get_surface_codes(surfaces):
+    return [SURFACE_CODES.get(surface) for surface in surfaces]
+
+
+class EloEngine:
+    """
+    Sequential Elo replay over integer-coded matches.
+
+    Ratings are kept in a list indexed by player id (see scripts/players.py), so a
+    replay is a loop over plain lists with no dictionary lookups or DataFrame access.
+    Every player starts at 1500 unless a starting rating is set with set_rating.
+    Alongside the ratings each player's peak rating, match count and last match_id are
+    kept, as stored in the player_ratings table.
+
+    Each surface has a second track of ratings, changed only by matches on it and with
+    the K and S of SURFACE_ELO_CONSTANTS, so overall and surface ratings are computed
+    in the same pass. A player's blended rating after a match mixes the two tracks.
+    """
+
+    def __init__(self):
+        self.ratings = []
+        self.surface_ratings = [[] for _ in SURFACES]
+        self.peaks = []
+        self.match_counts = []
+        self.last_match_ids = []
+
+    def get_rating(self, player_id):
+        if player_id < len(self.ratings):
+            return self.ratings[player_id]
+        return 1500
+
+    def set_rating(self, player_id, rating):
+        self.reserve(player_id)
+        self.ratings[player_id] = rating
+
+    def reserve(self, max_player_id):
+        missing = max_player_id + 1 - len(self.ratings)
+        if missing > 0:
+            self.ratings.extend([1500] * missing)
+            for ratings in self.surface_ratings:
+                ratings.extend([1500] * missing)
+            self.peaks.extend([1500] * missing)
+            self.match_counts.extend([0] * missing)
+            self.last_match_ids.extend([None] * missing)
+
+    def get_state(self):
+        return {
+            "version": ELO_STATE_VERSION,
+            "ratings": self.ratings,
+            "surface_ratings": self.surface_ratings,
+            "peaks": self.peaks,
+            "match_counts": self.match_counts,
+            "last_match_ids": self.last_match_ids,
+        }
+
+    def set_state(self, state):
+        self.ratings = state["ratings"]
+        self.surface_ratings = state["surface_ratings"]
+        self.peaks = state["peaks"]
+        self.match_counts = state["match_counts"]
+        self.last_match_ids = state["last_match_ids"]
+
+    def replay(self, match_ids, player_A_ids, player_B_ids, level_codes, surface_codes):
+        """
+        Play matches in order, player A winning each one, and return the ratings after
+        each match as tuples in ELO_COLUMNS order. The surface and blended ratings are
+        None for matches on a surface without a track. The engine's ratings are left as
+        of the last match, so a later call continues from them.
+        """
+        self.reserve(max(max(player_A_ids, default=0), max(player_B_ids, default=0)))
+        ratings = self.ratings
+        surface_ratings = self.surface_ratings
+        peaks = self.peaks
+        match_counts = self.match_counts
+        last_match_ids = self.last_match_ids
+        blend = BLENDED_ELO_SURFACE_WEIGHT
+        results = []
+
+        for match_id, A, B, level, surface in zip(
+            match_ids, player_A_ids, player_B_ids, level_codes, surface_codes
+        ):
+            k = LEVEL_K[level]
+            s = LEVEL_S[level]
+            A_previous_elo = ratings[A]
+            B_previous_elo = ratings[B]
+
+            # NumPy's power, as in calculate_elo, as Python's ** can round differently
+            eA = 1 / (1 + power(10, (B_previous_elo - A_previous_elo) / s))
+            eB = 1 / (1 + power(10, (A_previous_elo - B_previous_elo) / s))
+            A_new_elo = ratings[A] = A_previous_elo + k * (1 - eA)
+            B_new_elo = ratings[B] = B_previous_elo + k * (0 - eB)
+
+            if surface is None:
+                results.append((A_new_elo, B_new_elo, None, None, None, None))
+            else:
+                track = surface_ratings[surface]
+                k = SURFACE_K[level]
+                s = SURFACE_S[level]
+                A_previous_elo = track[A]
+                B_previous_elo = track[B]
+
+                # Python's ** is much faster than NumPy's power on floats, and the
+                # surface ratings have no older values to match
+                eA = 1 / (1 + 10 ** ((B_previous_elo - A_previous_elo) / s))
+                eB = 1 / (1 + 10 ** ((A_previous_elo - B_previous_elo) / s))
+                A_surface_elo = track[A] = A_previous_elo + k * (1 - eA)
+                B_surface_elo = track[B] = B_previous_elo + k * (0 - eB)
+
+                results.append(
+                    (
+                        A_new_elo,
+                        B_new_elo,
+                        A_surface_elo,
+                        B_surface_elo,
+                        blend * A_surface_elo + (1 - blend) * A_new_elo,
+                        blend * B_surface_elo + (1 - blend) * B_new_elo,
+                    )
+                )
+
+            # Only the winner's rating goes up, so only theirs can be a new peak
+            if A_new_elo > peaks[A]:
+                peaks[A] = A_new_elo
+            match_counts[A] += 1
+            match_counts[B] += 1
+            last_match_ids[A] = last_match_ids[B] = match_id
+
+        return results
+
+
+def create_elo_state_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS elo_dirty (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            from_match_id TEXT NOT NULL
+        )
+        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS elo_checkpoints (
+            as_of TEXT PRIMARY KEY,
+            ratings BLOB NOT NULL
+        )
+        """)
+    # Each player's rating after their last match, written with the match ratings
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_ratings (
+            player_id INTEGER PRIMARY KEY,
+            player_name TEXT NOT NULL,
+            elo REAL NOT NULL,
+            last_match_id TEXT NOT NULL,
+            peak_elo REAL NOT NULL,
+            match_count INTEGER NOT NULL
+        )
+        """)
+    existing_columns = [
+        column[1] for column in conn.execute("PRAGMA table_info(player_ratings)")
+    ]
+    for column in SURFACE_RATING_COLUMNS:
+        if column not in existing_columns:
+            conn.execute(f"ALTER TABLE player_ratings ADD COLUMN {column} REAL")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS player_ratings_last_match_id "
+        "ON player_ratings (last_match_id)"
+    )
+    conn.commit()
+
+
+def mark_elo_dirty(conn, from_match_id):
+    """
+    Record that from_match_id was inserted, changed or deleted, so the next Elo update
+    replays from it. Only the earliest dirty match is kept.
+    """
+    create_elo_state_tables(conn)
+    conn.execute(
+        "INSERT INTO elo_dirty (id, from_match_id) VALUES (0, ?) "
+        "ON CONFLICT (id) DO UPDATE "
+        "SET from_match_id = MIN(from_match_id, excluded.from_match_id)",
+        (from_match_id,),
+    )
+    conn.commit()
+
+
+def get_elo_dirty(conn):
+    """
+    Earliest match_id whose Elo may be out of date: the earliest marked match or match
+    without ratings. None when every rating is up to date.
+    """
+    create_elo_state_tables(conn)
+    marked = conn.execute("SELECT from_match_id FROM elo_dirty").fetchone()
+    unrated = conn.execute(
+        "SELECT MIN(match_id) FROM tennis_matches "
+        "WHERE A_elo IS NULL OR B_elo IS NULL"
+    ).fetchone()
+    dirty = [row[0] for row in [marked, unrated] if row and row[0] is not None]
+    return min(dirty, default=None)
+
+
+def clear_elo_dirty(conn):
+    conn.execute("DELETE FROM elo_dirty")
+
+
+def save_elo_checkpoint(conn, as_of, engine):
+    """Store the engine's state as of the first match on or after as_of."""
+    conn.execute(
+        "INSERT OR REPLACE INTO elo_checkpoints (as_of, ratings) VALUES (?, ?)",
+        (
+            as_of,
+            zlib.compress(
+                pickle.dumps(engine.get_state(), protocol=pickle.HIGHEST_PROTOCOL)
+            ),
+        ),
+    )
+
+
+def load_elo_checkpoint(conn, match_id):
+    """
+    Return an engine with the state of the newest checkpoint at or before match_id,
+    and the checkpoint's as_of, or a new engine and "" when there is none.
+    """
+    create_elo_state_tables(conn)
+    engine = EloEngine()
+    row = conn.execute(
+        "SELECT as_of, ratings FROM elo_checkpoints WHERE as_of <= ? "
+        "ORDER BY as_of DESC LIMIT 1",
+        (match_id,),
+    ).fetchone()
+    if row is None:
+        return engine, ""
+    state = pickle.loads(zlib.decompress(row[1]))
+    if not isinstance(state, dict) or state.get("version") != ELO_STATE_VERSION:
+        # Checkpoints stored by an older engine are replayed from the start
+        return engine, ""
+    engine.set_state(state)
+    return engine, row[0]
+
+
+def delete_elo_checkpoints(conn, from_match_id=""):
+    """Delete every checkpoint after from_match_id, or every one with no match id."""
+    create_elo_state_tables(conn)
+    conn.execute("DELETE FROM elo_checkpoints WHERE as_of > ?", (from_match_id,))
+
+
+def get_rated_to(conn):
+    """The last match_id in player_ratings, or None when it is empty."""
+    create_elo_state_tables(conn)
+    return conn.execute("SELECT MAX(last_match_id) FROM player_ratings").fetchone()[0]
+
+
+def load_player_ratings(conn):
+    """Return an engine with every player's state read from player_ratings."""
+    create_elo_state_tables(conn)
+    engine = EloEngine()
+    rows = conn.execute(
+        "SELECT player_id, elo, last_match_id, peak_elo, match_count, "
+        f"{', '.join(SURFACE_RATING_COLUMNS)} FROM player_ratings"
+    ).fetchall()
+    engine.reserve(max((row[0] for row in rows), default=0))
+    for player_id, elo, last_match_id, peak_elo, match_count, *surface_elos in rows:
+        engine.ratings[player_id] = elo
+        engine.last_match_ids[player_id] = last_match_id
+        engine.peaks[player_id] = peak_elo
+        engine.match_counts[player_id] = match_count
+        for ratings, surface_elo in zip(engine.surface_ratings, surface_elos):
+            ratings[player_id] = surface_elo
+    return engine
+
+
+def write_player_ratings(conn, engine):
+    """
+    Write the rows of player_ratings that differ from the engine's state, and delete
+    those of players with no matches left. Nothing is committed, so the rows can be
+    written in the same transaction as the match ratings.
+    """
+    columns = [
+        "elo",
+        "last_match_id",
+        "peak_elo",
+        "match_count",
+    ] + SURFACE_RATING_COLUMNS
+    stored = {
+        row[0]: row[1:]
+        for row in conn.execute(
+            f"SELECT player_id, {', '.join(columns)} FROM player_ratings"
+        )
+    }
+    changed = []
+    for player_id, match_count in enumerate(engine.match_counts):
+        if match_count == 0:
+            continue
+        values = (
+            engine.ratings[player_id],
+            engine.last_match_ids[player_id],
+            engine.peaks[player_id],
+            match_count,
+        ) + tuple(ratings[player_id] for ratings in engine.surface_ratings)
+        if stored.pop(player_id, None) != values:
+            changed.append((player_id,) + values)
+
+    # Each player is named as in their last match
+    name_query = (
+        "SELECT CASE WHEN A_player_id = ? THEN A_name ELSE B_name END "
+        "FROM tennis_matches WHERE match_id = ?"
+    )
+    conn.executemany(
+        f"INSERT OR REPLACE INTO player_ratings (player_id, player_name, "
+        f"{', '.join(columns)}) VALUES ({', '.join(['?'] * (len(columns) + 2))})",
+        [
+            (row[0], conn.execute(name_query, (row[0], row[2])).fetchone()[0]) + row[1:]
+            for row in changed
+        ],
+    )
+    conn.executemany(
+        "DELETE FROM player_ratings WHERE player_id = ?",
+        [(player_id,) for player_id in stored],
+    )
@@ -0,0 +1,475 @@
+import math
+from bisect import bisect_left, bisect_right, insort
+
+from config.config import ELO_CONSTANTS
+from scripts.conditions import (
+    CONDITION_COLUMNS,
+    compile_conditions,
+    get_condition_value,
+)
+from scripts.data_helpers import (
+    add_to_variance,
+    get_day,
+    get_games,
+    get_match_day,
+    get_variance,
+    get_window_start,
+)
+from scripts.feature_selection import ALL_FEATURES, STAT_FAMILIES
+from scripts.h2h_index import H2HIndex
+from scripts.stats import (
+    get_h2h_conditions,
+    get_match_context,
+    get_performance_conditions,
+    get_variance_conditions,
+)
+
+# Condition shapes (sorted condition keys, excluding weeks) whose Elo performance
+# and win-loss record are kept as running totals for the player's whole history
+PERFORMANCE_SHAPES = [
+    (),
+    ("surface",),
+    ("IOC",),
+    ("tourney_name",),
+    ("tourney_key",),
+    ("round",),
+    ("tourney_level",),
+    ("surface", "tourney_level"),
+]
+
+# Condition shapes whose Elo change variance is kept as running totals. Running totals
+# round differently from the variance of each window's list in stats.get_elo_variance,
+# so these stats can differ from it in the last few digits (see
+# benchmark_stats.VARIANCE_TOLERANCE). The difference is accepted for the O(1) updates
+VARIANCE_SHAPES = [(), ("surface",), ("tourney_level",), ("round",)]
+
+
+class PlayerState:
+    """
+    Rolling state for a single player, built by adding their matches in match_id order.
+
+    The history is stored column by column, together with posting lists of row indices
+    for every condition value, running Elo performance and win-loss totals for each of
+    the PERFORMANCE_SHAPES and running Elo change variances for the VARIANCE_SHAPES.
+    The player's average serve ratings are also kept sorted, as (rating, row) pairs,
+    for serve rating range queries.
+    """
+
+    def __init__(self, player_name):
+        self.player_name = player_name
+        self.match_ids = []
+        self.days = []
+        self.elos = []
+        self.opponent_elos = []
+        self.results = []
+        self.levels = []
+        self.games = []
+        self.cumulative_games = []
+        self.last_played = []
+        self.values = {key: [] for key in CONDITION_COLUMNS}
+        self.postings = {}
+        self.performance = {}
+        self.variance = {}
+        self.cumulative_change = []
+        self.cumulative_change_sq = []
+        self.window_cache = {}
+        self.peak_elo = 1500
+        self.serve_ratings = []
+
+    def __getstate__(self):
+        # The window cache only saves work, so snapshots and checkpoints leave it out
+        state = self.__dict__.copy()
+        state["window_cache"] = {}
+        return state
+
+    def add_match(self, match):
+        i = len(self.match_ids)
+
+        if match["A_simplified_name"] == self.player_name:
+            elo, opponent_elo = match["A_elo"], match["B_elo"]
+            result = 1
+        else:
+            elo, opponent_elo = match["B_elo"], match["A_elo"]
+            result = 0
+
+        self.match_ids.append(match["match_id"])
+        self.days.append(get_day(match))
+        self.elos.append(elo)
+        self.opponent_elos.append(opponent_elo)
+        self.results.append(result)
+        self.levels.append(match["tourney_level"])
+        games = get_games(match)
+        self.games.append(games)
+        self.cumulative_games.append(
+            games + (self.cumulative_games[-1] if self.cumulative_games else 0)
+        )
+        self.last_played.append(
+            i if games else (self.last_played[-1] if self.last_played else -1)
+        )
+
+        serve_rating = match.get(
+            "A_avg_serve_rating" if result else "B_avg_serve_rating"
+        )
+        if serve_rating is not None and not math.isnan(serve_rating):
+            insort(self.serve_ratings, (serve_rating, i))
+
+        for key, column in CONDITION_COLUMNS.items():
+            value = get_condition_value(key, match.get(column))
+            self.values[key].append(value)
+            self.postings.setdefault((key, value), []).append(i)
+
+        for shape in PERFORMANCE_SHAPES:
+            performance_key = tuple((key, self.values[key][i]) for key in shape)
+            totals = self.performance.get(performance_key)
+            if totals is None:
+                totals = self.performance[performance_key] = [1500, 0, 0]
+            self.add_to_totals(totals, i)
+
+        # Elo changes between consecutive matches, overall and within each bucket
+        elo_change = self.elos[-2] - elo if i else 0.0
+        self.cumulative_change.append(
+            elo_change + (self.cumulative_change[-1] if i else 0.0)
+        )
+        self.cumulative_change_sq.append(
+            elo_change**2 + (self.cumulative_change_sq[-1] if i else 0.0)
+        )
+        for shape in VARIANCE_SHAPES:
+            variance_key = tuple((key, self.values[key][i]) for key in shape)
+            totals = self.variance.get(variance_key)
+            if totals is None:
+                self.variance[variance_key] = [0, 0.0, 0.0, elo]
+            else:
+                add_to_variance(totals, totals[3] - elo)
+                totals[3] = elo
+
+        if elo > self.peak_elo:
+            self.peak_elo = elo
+
+    def add_to_totals(self, totals, i):
+        """Apply row i to a [performance elo, wins, losses] list in place."""
+        elo_k = ELO_CONSTANTS[self.levels[i]]["K"]
+        elo_s = ELO_CONSTANTS[self.levels[i]]["S"]
+        win_prob = 1 / (1 + 10 ** ((self.opponent_elos[i] - totals[0]) / elo_s))
+        totals[0] = totals[0] + elo_k * (self.results[i] - win_prob)
+        if self.results[i]:
+            totals[1] += 1
+        else:
+            totals[2] += 1
+
+    def first_on_or_after(self, rows, day):
+        """Binary search for the first position in rows played on or after day."""
+        lo, hi = 0, len(rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.days[rows[mid]] < day:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def matches_items(self, i, items):
+        for key, value in items:
+            if self.values[key][i] != value:
+                return False
+        return True
+
+    def select(self, spec, day, rows=None):
+        """
+        Narrow the history down to the candidate rows of a condition, given as one of
+        the (weeks, items) specs of a ConditionPlan.
+
+        Returns a sorted list of row indices that contains every matching row, and the
+        position in that list where the weeks window starts.
+        """
+        weeks, items = spec
+        if rows is None:
+            if items:
+                rows = min(
+                    (self.postings.get(item, []) for item in items),
+                    key=len,
+                )
+            else:
+                rows = range(len(self.match_ids))
+
+        start = 0
+        if weeks is not None:
+            start = self.first_on_or_after(rows, get_window_start(day, weeks))
+
+        return rows, start
+
+    def get_previous_elo(self):
+        return self.elos[-1] if self.elos else 1500
+
+    def get_peak_elo(self):
+        return self.peak_elo
+
+    def days_since_debut(self):
+        # Mirrors stats.days_since_debut, which measures up to the most recent match
+        return self.days[-1] - self.days[0] if self.days else 0
+
+    def games_since(self, start):
+        """Games played from row start onwards, from the running games total."""
+        n = len(self.match_ids)
+        if start >= n:
+            return 0
+        return self.cumulative_games[-1] - (
+            self.cumulative_games[start - 1] if start > 0 else 0
+        )
+
+    def get_fatigue_scores(self, match_id, day):
+        month_start = bisect_left(self.days, day - 30)
+        week_start = bisect_left(self.days, day - 14)
+        tournament_start = bisect_left(
+            self.match_ids, "_".join(match_id.split("_")[:2]) + "_"
+        )
+
+        last_played = self.last_played[-1] if self.last_played else -1
+        last_match_games = self.games[last_played] if last_played >= month_start else 0
+
+        tournament_games = self.games_since(max(tournament_start, month_start))
+        week_games = self.games_since(week_start)
+        month_games = self.games_since(month_start)
+
+        return [last_match_games, tournament_games, week_games, month_games]
+
+    def get_window_variance(self, start):
+        """Variance of the Elo changes between consecutive matches from row start on."""
+        n = len(self.match_ids)
+        count = n - 1 - start
+        if count <= 1:
+            return 0
+        change_sum = self.cumulative_change[-1] - self.cumulative_change[start]
+        change_sq_sum = self.cumulative_change_sq[-1] - self.cumulative_change_sq[start]
+        return max((change_sq_sum - change_sum**2 / count) / count, 0.0)
+
+    def get_elo_variance(self, conditions_list, day):
+        results = []
+        for weeks, items in compile_conditions(conditions_list).specs:
+            rows, start = self.select((weeks, items), day)
+
+            # Weeks windows and the VARIANCE_SHAPES are read from running totals
+            shape = tuple(key for key, _ in items)
+            if weeks is not None:
+                if not shape:
+                    results.append(self.get_window_variance(start))
+                    continue
+            elif shape in VARIANCE_SHAPES:
+                totals = self.variance.get(items)
+                results.append(get_variance(totals[0], totals[2]) if totals else 0)
+                continue
+
+            elo_changes = []
+            previous_elo = 0
+            for j in range(len(rows) - 1, start - 1, -1):
+                i = rows[j]
+                if not self.matches_items(i, items):
+                    continue
+                if previous_elo != 0:
+                    elo_changes.append(self.elos[i] - previous_elo)
+                previous_elo = self.elos[i]
+
+            if len(elo_changes) > 1:
+                mean = sum(elo_changes) / len(elo_changes)
+                results.append(
+                    sum([(elo - mean) ** 2 for elo in elo_changes]) / len(elo_changes)
+                )
+            else:
+                results.append(0)
+
+        return results
+
+    def serve_rating_rows(self, serve_rating, margin):
+        """
+        Rows whose serve rating is within margin of serve_rating, in ascending order,
+        found with two binary searches over the sorted serve ratings.
+        """
+        start = bisect_left(self.serve_ratings, (serve_rating - margin,))
+        end = bisect_right(self.serve_ratings, (serve_rating + margin, math.inf))
+        return sorted(row for _, row in self.serve_ratings[start:end])
+
+    def get_performance(self, spec, day, serve_rating_margin=None):
+        """
+        Return [performance elo, wins, losses] for a (weeks, items) condition spec,
+        matching get_elo_performance and get_win_loss_record.
+        """
+        items = spec[1]
+
+        # Only the rows in the serve rating range are replayed, starting from the
+        # window's first one
+        if serve_rating_margin is not None:
+            rows, start = self.select(
+                spec, day, self.serve_rating_rows(*serve_rating_margin)
+            )
+            totals = [1500, 0, 0]
+            for i in rows[start:]:
+                if self.matches_items(i, items):
+                    self.add_to_totals(totals, i)
+            return totals
+
+        rows, start = self.select(spec, day)
+
+        shape = tuple(key for key, _ in items)
+        if start == 0 and shape in PERFORMANCE_SHAPES:
+            totals = self.performance.get(items)
+            return list(totals) if totals is not None else [1500, 0, 0]
+
+        # Replay the window, continuing from a cached replay when the window still
+        # starts at the same row
+        n = len(self.match_ids)
+        first_row = rows[start] if start < len(rows) else None
+        cached = self.window_cache.get(spec)
+        if cached is not None and cached[0] == first_row:
+            position = bisect_left(rows, cached[1], start)
+            totals = list(cached[2])
+        else:
+            position = start
+            totals = [1500, 0, 0]
+
+        for j in range(position, len(rows)):
+            i = rows[j]
+            if self.matches_items(i, items):
+                self.add_to_totals(totals, i)
+
+        self.window_cache[spec] = (first_row, n, tuple(totals))
+        return totals
+
+    def get_performance_stats(self, conditions_list, day, serve_rating_margin=None):
+        performance_stats = []
+        win_loss_stats = []
+        for spec in compile_conditions(conditions_list).specs:
+            elo, wins, losses = self.get_performance(spec, day, serve_rating_margin)
+            performance_stats.append(elo)
+            win_loss_stats.extend([wins, losses])
+        return performance_stats, win_loss_stats
+
+
+class FeatureEngine:
+    """
+    Incremental replacement for stats.get_match_stats.
+
+    Matches are fed to update() in match_id order; get_match_stats() returns the same
+    STAT_LABELS vector as stats.get_match_stats for a match using every match the
+    engine has seen so far as the players' histories.
+    """
+
+    def __init__(self):
+        self.players = {}
+        self.h2h_index = H2HIndex()
+
+    def get_player(self, player_name):
+        player = self.players.get(player_name)
+        if player is None:
+            player = PlayerState(player_name)
+        return player
+
+    def update(self, match):
+        for player_name in [match["A_simplified_name"], match["B_simplified_name"]]:
+            if player_name not in self.players:
+                self.players[player_name] = PlayerState(player_name)
+            self.players[player_name].add_match(match)
+        self.h2h_index.add_match(match)
+
+    def get_match_stats(self, match, player_A=None, player_B=None, selection=None):
+        """
+        STAT_LABELS vector of a match. With a FeatureSelection, only the stats it needs
+        are computed and the others are left as 0, as in stats.get_match_stats.
+        """
+        if player_A is None:
+            player_A = match["A_simplified_name"]
+        if player_B is None:
+            player_B = match["B_simplified_name"]
+        if selection is None:
+            selection = ALL_FEATURES
+
+        A = self.get_player(player_A)
+        B = self.get_player(player_B)
+        match_id = match["match_id"]
+        day = get_match_day(match_id)
+
+        X_dict = get_match_context(match)
+        X_dict.update(
+            dict.fromkeys(
+                [label for labels in STAT_FAMILIES.values() for label in labels], 0
+            )
+        )
+
+        if "previous_elo" in selection.families:
+            X_dict["A_previous_elo"] = A.get_previous_elo()
+            X_dict["B_previous_elo"] = B.get_previous_elo()
+        if "peak_elo" in selection.families:
+            X_dict["A_peak_elo"] = A.get_peak_elo()
+            X_dict["B_peak_elo"] = B.get_peak_elo()
+        if "days_since_debut" in selection.families:
+            X_dict["A_days_since_debut"] = A.days_since_debut()
+            X_dict["B_days_since_debut"] = B.days_since_debut()
+
+        if "fatigue" in selection.families:
+            (
+                X_dict["A_last_match_games"],
+                X_dict["A_tournament_games"],
+                X_dict["A_week_games"],
+                X_dict["A_month_games"],
+            ) = A.get_fatigue_scores(match_id, day)
+            (
+                X_dict["B_last_match_games"],
+                X_dict["B_tournament_games"],
+                X_dict["B_week_games"],
+                X_dict["B_month_games"],
+            ) = B.get_fatigue_scores(match_id, day)
+
+        variance_conditions = selection.select(
+            "variance", get_variance_conditions(match)
+        )
+        A_variance_stats = A.get_elo_variance(variance_conditions, day)
+        B_variance_stats = B.get_elo_variance(variance_conditions, day)
+
+        h2h_conditions = selection.select("h2h", get_h2h_conditions(match))
+        h2h_stats = []
+        if h2h_conditions:
+            h2h_stats = self.h2h_index.get_h2h(
+                player_A, player_B, match_id, h2h_conditions
+            )
+
+        performance_conditions = selection.select(
+            "performance", get_performance_conditions(match)
+        )
+        A_performance_stats, A_win_loss_stats = A.get_performance_stats(
+            performance_conditions, day
+        )
+        B_performance_stats, B_win_loss_stats = B.get_performance_stats(
+            performance_conditions, day
+        )
+
+        A_win_loss_stats = selection.expand(
+            "performance", zip(A_win_loss_stats[0::2], A_win_loss_stats[1::2]), (0, 0)
+        )
+        B_win_loss_stats = selection.expand(
+            "performance", zip(B_win_loss_stats[0::2], B_win_loss_stats[1::2]), (0, 0)
+        )
+        h2h_stats = selection.expand("h2h", h2h_stats, (0, 0))
+
+        data_list = (
+            list(X_dict.values())
+            + selection.expand("performance", A_performance_stats)
+            + selection.expand("performance", B_performance_stats)
+            + [stat for stats in A_win_loss_stats for stat in stats]
+            + [stat for stats in B_win_loss_stats for stat in stats]
+            + [stat for stats in h2h_stats for stat in stats]
+            + selection.expand("variance", A_variance_stats)
+            + selection.expand("variance", B_variance_stats)
+        )
+
+        return data_list
+
+
+def iterate_matches(
+    conn, query="SELECT * FROM tennis_matches ORDER BY match_id", parameters=()
+):
+    """
+    Stream the rows of tennis_matches as dictionaries without loading the whole table.
+    """
+    cursor = conn.cursor()
+    cursor.execute(query, parameters)
+    columns = [column[0] for column in cursor.description]
+    for row in cursor:
+        yield dict(zip(columns, row))
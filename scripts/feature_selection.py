@@ -0,0 +1,148 @@
+import json
+
+import numpy as np
+
+from config.config import STAT_LABELS, h2h_labels, performance_labels, variance_labels
+
+# Stats of get_match_stats computed once per player rather than per condition, with
+# their labels in STAT_LABELS order
+STAT_FAMILIES = {
+    "previous_elo": ["A_previous_elo", "B_previous_elo"],
+    "peak_elo": ["A_peak_elo", "B_peak_elo"],
+    "days_since_debut": ["A_days_since_debut", "B_days_since_debut"],
+    "fatigue": [
+        "A_last_match_games",
+        "A_tournament_games",
+        "A_week_games",
+        "A_month_games",
+        "B_last_match_games",
+        "B_tournament_games",
+        "B_week_games",
+        "B_month_games",
+    ],
+}
+
+# Labels of the stats computed for each condition of the performance, h2h and variance
+# condition lists, in the order of config.performance_labels and friends
+CONDITION_LABELS = {
+    "performance": [
+        [
+            f"{player}_{prefix}{label}"
+            for player in ["A", "B"]
+            for prefix in ["", "wins_", "losses_"]
+        ]
+        for label in performance_labels
+    ],
+    "h2h": [[f"A_h2h_{label}", f"B_h2h_{label}"] for label in h2h_labels],
+    "variance": [
+        [f"A_variance_{label}", f"B_variance_{label}"] for label in variance_labels
+    ],
+}
+
+
+def get_swap_permutation(labels):
+    """
+    Indices that turn a feature vector for player A against player B into the vector
+    for B against A, so the swapped vector is features[..., permutation].
+
+    Labels starting with A_ or B_ trade places with their counterpart, which also
+    flips both sides of every h2h record. Every other label describes the match itself
+    and stays where it is.
+    """
+    positions = {label: i for i, label in enumerate(labels)}
+    permutation = []
+    for label in labels:
+        if label.startswith("A_"):
+            counterpart = "B_" + label[2:]
+        elif label.startswith("B_"):
+            counterpart = "A_" + label[2:]
+        else:
+            counterpart = label
+        if counterpart not in positions:
+            raise ValueError(f"{label} has no {counterpart} label to swap with")
+        permutation.append(positions[counterpart])
+    return np.array(permutation)
+
+
+SWAP_PERMUTATION = get_swap_permutation(STAT_LABELS)
+
+
+class FeatureSelection:
+    """
+    The STAT_LABELS a model takes as input, in order, and the stats get_match_stats
+    has to compute to produce them.
+
+    A B vs A vector is a permutation of the A vs B one, so a stat is needed when its
+    label or its swap counterpart is selected. Stats of the STAT_FAMILIES are skipped
+    family by family and condition stats condition by condition.
+
+    Attributes:
+    labels (list): Selected labels, in the model's input order.
+    indices (np.array): Positions of the selected labels in STAT_LABELS.
+    families (set): Names of the STAT_FAMILIES that have to be computed.
+    conditions (dict): For each kind in CONDITION_LABELS, the indices of the
+                       conditions that have to be computed.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = list(STAT_LABELS if labels is None else labels)
+
+        positions = {label: i for i, label in enumerate(STAT_LABELS)}
+        unknown = [label for label in self.labels if label not in positions]
+        if unknown:
+            raise ValueError(f"Unknown stat labels: {', '.join(unknown)}")
+        self.indices = np.array([positions[label] for label in self.labels], dtype=int)
+
+        required = {STAT_LABELS[i] for i in self.indices} | {
+            STAT_LABELS[i] for i in SWAP_PERMUTATION[self.indices]
+        }
+        self.families = {
+            family
+            for family, family_labels in STAT_FAMILIES.items()
+            if required.intersection(family_labels)
+        }
+        self.conditions = {
+            kind: [
+                i
+                for i, condition_labels in enumerate(labels_list)
+                if required.intersection(condition_labels)
+            ]
+            for kind, labels_list in CONDITION_LABELS.items()
+        }
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)["labels"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"labels": self.labels}, f, indent=4)
+
+    def narrow(self, mask):
+        """Selection of the labels whose entry in mask, one per selected label, is True."""
+        if len(mask) != len(self.labels):
+            raise ValueError(
+                f"Mask has {len(mask)} entries for {len(self.labels)} labels"
+            )
+        return FeatureSelection(
+            [label for label, keep in zip(self.labels, mask) if keep]
+        )
+
+    def select(self, kind, conditions_list):
+        """The conditions of a kind's condition list that have to be computed."""
+        return [conditions_list[i] for i in self.conditions[kind]]
+
+    def expand(self, kind, stats, default=0):
+        """
+        Spread the stats of the selected conditions back to one entry per condition of
+        the full list, filling the skipped conditions with default.
+        """
+        expanded = [default] * len(CONDITION_LABELS[kind])
+        for i, stat in zip(self.conditions[kind], stats):
+            expanded[i] = stat
+        return expanded
+
+
+# Every stat, which is what models saved without a selection take as input
+ALL_FEATURES = FeatureSelection()
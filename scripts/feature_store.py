@@ -0,0 +1,374 @@
+import glob
+import hashlib
+import os
+import pickle
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from alive_progress import alive_bar
+
+from config.config import STAT_LABELS
+from scripts.feature_engine import FeatureEngine, iterate_matches
+from scripts.player_history import PlayerHistory
+from scripts.player_snapshots import delete_player_snapshots
+from scripts.stats import get_all_matches_for_players, get_match_stats
+
+# Bump whenever a change to the stats code changes the values of any feature, so rows
+# computed by the old code are treated as stale
+FEATURE_VERSION = 1
+
+# Identifies the STAT_LABELS list the stored vectors follow
+LABELS_HASH = hashlib.sha1("\n".join(STAT_LABELS).encode()).hexdigest()[:16]
+
+# Matches the model is trained on, and so the ones kept in the store
+TRAINING_FILTER = "match_id >= '2000' AND tourney_level != 'F'"
+
+# Features need the players' simplified names, so only matches selected by this have
+# rows in the store
+STORABLE_FILTER = "A_simplified_name IS NOT NULL"
+
+# FeatureEngine states pickled as of the start of a year of match ids, named
+# {LABELS_HASH}_{FEATURE_VERSION}_{CHECKPOINT_VERSION}_{year}.pkl
+CHECKPOINT_DIR = "data/feature_checkpoints"
+
+# Bump whenever the FeatureEngine's pickled state changes, so checkpoints of the old
+# state are deleted rather than loaded
+CHECKPOINT_VERSION = 2
+
+# Checkpoints are only taken at the start of each year of match ids, like the Elo
+# checkpoints, so there is at most one per year however many shards there are
+CHECKPOINT_PREFIX_LENGTH = 4
+
+# Above this many missing matches, replaying the whole table through a FeatureEngine is
+# cheaper than loading the histories of every player involved
+MAX_HISTORY_MATCHES = 2000
+
+
+def create_feature_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS match_features (
+            match_id TEXT PRIMARY KEY,
+            A_simplified_name TEXT NOT NULL,
+            B_simplified_name TEXT NOT NULL,
+            features BLOB NOT NULL,
+            labels_hash TEXT NOT NULL,
+            feature_version INTEGER NOT NULL
+        )
+        """)
+    conn.commit()
+
+
+def delete_stale_features(conn):
+    """Delete rows computed for another label list or feature version."""
+    conn.execute(
+        "DELETE FROM match_features WHERE labels_hash != ? OR feature_version != ?",
+        (LABELS_HASH, FEATURE_VERSION),
+    )
+    conn.commit()
+
+
+def invalidate_features(conn, from_match_id=""):
+    """
+    Delete the rows of from_match_id and every later match. Features only depend on
+    earlier matches, so this is needed whenever matches are added or changed before
+    matches that already have features. With no match id the whole store is cleared.
+    Engine checkpoints and player snapshots that include the changed matches go too.
+    """
+    create_feature_table(conn)
+    conn.execute("DELETE FROM match_features WHERE match_id >= ?", (from_match_id,))
+    conn.commit()
+    delete_checkpoints(from_match_id)
+    delete_player_snapshots(conn, from_match_id)
+
+
+def save_features(conn, rows):
+    """
+    Write (match_id, A_simplified_name, B_simplified_name, features) rows, replacing
+    any existing row of the same match.
+    """
+    conn.executemany(
+        "INSERT OR REPLACE INTO match_features VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                match_id,
+                player_A,
+                player_B,
+                np.asarray(features, dtype=np.float32).tobytes(),
+                LABELS_HASH,
+                FEATURE_VERSION,
+            )
+            for match_id, player_A, player_B, features in rows
+        ],
+    )
+    conn.commit()
+
+
+def load_features(conn, match_ids=None):
+    """
+    Load current feature vectors as float32 arrays.
+
+    Returns:
+    dict: {match_id: (A_simplified_name, B_simplified_name, features)} for every
+          requested match, or every match when match_ids is None, with a current row.
+    """
+    query = (
+        "SELECT match_id, A_simplified_name, B_simplified_name, features "
+        "FROM match_features WHERE labels_hash = ? AND feature_version = ?"
+    )
+    create_feature_table(conn)
+
+    if match_ids is None:
+        cursors = [conn.execute(query, (LABELS_HASH, FEATURE_VERSION))]
+    else:
+        match_ids = list(dict.fromkeys(match_ids))
+        cursors = (
+            conn.execute(
+                query + f" AND match_id IN ({', '.join('?' * len(chunk))})",
+                [LABELS_HASH, FEATURE_VERSION] + chunk,
+            )
+            for chunk in (match_ids[i : i + 500] for i in range(0, len(match_ids), 500))
+        )
+
+    features = {}
+    for cursor in cursors:
+        for match_id, player_A, player_B, blob in cursor:
+            features[match_id] = (
+                player_A,
+                player_B,
+                np.frombuffer(blob, dtype=np.float32),
+            )
+    return features
+
+
+def get_missing_match_ids(conn, where=TRAINING_FILTER):
+    """Match ids selected by where that have no current row in the store."""
+    cursor = conn.execute(
+        f"""
+        SELECT match_id FROM tennis_matches
+        WHERE {where} AND {STORABLE_FILTER} AND match_id NOT IN (
+            SELECT match_id FROM match_features
+            WHERE labels_hash = ? AND feature_version = ?
+        )
+        ORDER BY match_id
+        """,
+        (LABELS_HASH, FEATURE_VERSION),
+    )
+    return [row[0] for row in cursor]
+
+
+def update_features(conn, where=TRAINING_FILTER, batch_size=10000, workers=1):
+    """
+    Compute and store the features of every match selected by where that is missing
+    from the store or stale. Returns the number of matches computed.
+
+    With more than one worker, a large number of missing matches is split into time
+    shards that are computed in parallel (see compute_features_in_parallel).
+    """
+    create_feature_table(conn)
+    delete_stale_features(conn)
+
+    missing = get_missing_match_ids(conn, where)
+    if not missing:
+        return 0
+
+    if len(missing) > MAX_HISTORY_MATCHES and workers > 1:
+        compute_features_in_parallel(conn, missing, workers)
+    elif len(missing) > MAX_HISTORY_MATCHES:
+        compute_features_by_replay(conn, set(missing), batch_size)
+    else:
+        compute_features_by_history(conn, missing)
+
+    return len(missing)
+
+
+def compute_features_by_replay(conn, match_ids, batch_size):
+    """Walk the whole table once with a FeatureEngine, storing the missing matches."""
+    engine = FeatureEngine()
+    rows = []
+    with alive_bar(len(match_ids), title="Computing features") as bar:
+        for m in iterate_matches(conn):
+            if m["match_id"] in match_ids:
+                rows.append(
+                    (
+                        m["match_id"],
+                        m["A_simplified_name"],
+                        m["B_simplified_name"],
+                        engine.get_match_stats(m),
+                    )
+                )
+                bar()
+
+                if len(rows) >= batch_size:
+                    save_features(conn, rows)
+                    rows = []
+
+            engine.update(m)
+
+    save_features(conn, rows)
+
+
+def compute_features_by_history(conn, match_ids):
+    """Compute a few missing matches from the histories of the players involved."""
+    matches = []
+    for i in range(0, len(match_ids), 500):
+        chunk = match_ids[i : i + 500]
+        cursor = conn.execute(
+            "SELECT * FROM tennis_matches WHERE match_id IN "
+            f"({', '.join('?' * len(chunk))}) ORDER BY match_id",
+            chunk,
+        )
+        columns = [column[0] for column in cursor.description]
+        matches += [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # Every player's history, read in one indexed pass
+    histories = {
+        player_name: PlayerHistory.from_matches(player_name, player_matches)
+        for player_name, player_matches in get_all_matches_for_players(
+            [m[f"{side}_simplified_name"] for m in matches for side in "AB"], conn
+        ).items()
+    }
+    rows = []
+    with alive_bar(len(matches), title="Computing features") as bar:
+        for m in matches:
+            player_A = m["A_simplified_name"]
+            player_B = m["B_simplified_name"]
+            data_list = get_match_stats(
+                m,
+                player_A,
+                player_B,
+                histories[player_A].before(m["match_id"]),
+                histories[player_B].before(m["match_id"]),
+            )
+            rows.append((m["match_id"], player_A, player_B, data_list))
+            bar()
+
+    save_features(conn, rows)
+
+
+def get_checkpoint_path(year):
+    return os.path.join(
+        CHECKPOINT_DIR,
+        f"{LABELS_HASH}_{FEATURE_VERSION}_{CHECKPOINT_VERSION}_{year}.pkl",
+    )
+
+
+def get_checkpoints():
+    """Years of the current checkpoints, in order."""
+    prefix = get_checkpoint_path("")[:-4]
+    return sorted(path[len(prefix) : -4] for path in glob.glob(f"{prefix}*.pkl"))
+
+
+def delete_checkpoints(from_match_id=""):
+    """
+    Delete every checkpoint taken after from_match_id, as it includes that match, and
+    every checkpoint of another label list, feature version or checkpoint version.
+    """
+    current = get_checkpoint_path("")[:-4]
+    for path in glob.glob(os.path.join(CHECKPOINT_DIR, "*.pkl")):
+        if not path.startswith(current) or path[len(current) : -4] > from_match_id:
+            os.remove(path)
+
+
+def load_checkpoint(match_id):
+    """
+    Return the engine of the nearest checkpoint at or before match_id and the year it
+    was taken as of, or a new engine and "" when there is none.
+    """
+    years = [year for year in get_checkpoints() if year <= match_id]
+    if not years:
+        return FeatureEngine(), ""
+    with open(get_checkpoint_path(years[-1]), "rb") as f:
+        return pickle.load(f), years[-1]
+
+
+def save_checkpoints(conn, match_ids):
+    """
+    Make sure there is a checkpoint as of the start of the year of each of match_ids,
+    replaying the table from the nearest earlier checkpoint. Only engine updates are
+    replayed, which is much cheaper than computing features.
+    """
+    # Checkpoints of other versions are never loaded again, so they are pruned here
+    # as well as when features are invalidated
+    existing = set(get_checkpoints())
+    delete_checkpoints(max(existing, default=""))
+    needed = sorted(
+        {match_id[:CHECKPOINT_PREFIX_LENGTH] for match_id in match_ids} - existing
+    )
+    if not needed:
+        return
+
+    engine, start = load_checkpoint(needed[0])
+
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    query = (
+        "SELECT * FROM tennis_matches WHERE match_id >= ? AND match_id < ? "
+        "ORDER BY match_id"
+    )
+    with alive_bar(len(needed), title="Saving checkpoints") as bar:
+        for year in needed:
+            for m in iterate_matches(conn, query, (start, year)):
+                engine.update(m)
+            with open(get_checkpoint_path(year), "wb") as f:
+                pickle.dump(engine, f, protocol=pickle.HIGHEST_PROTOCOL)
+            start = year
+            bar()
+
+
+def compute_shard(db_path, match_ids):
+    """
+    Compute the features of a shard of match ids, in a worker process. The engine
+    starts from the checkpoint of the year of the shard's first match and replays the
+    matches before the shard with engine updates only.
+    """
+    engine, start = load_checkpoint(match_ids[0])
+    wanted = set(match_ids)
+
+    conn = sqlite3.connect(db_path)
+    rows = []
+    for m in iterate_matches(
+        conn,
+        "SELECT * FROM tennis_matches WHERE match_id >= ? AND match_id <= ? "
+        "ORDER BY match_id",
+        (start, match_ids[-1]),
+    ):
+        if m["match_id"] in wanted:
+            features = np.asarray(engine.get_match_stats(m), dtype=np.float32)
+            rows.append(
+                (
+                    m["match_id"],
+                    m["A_simplified_name"],
+                    m["B_simplified_name"],
+                    features,
+                )
+            )
+        engine.update(m)
+    conn.close()
+
+    return rows
+
+
+def compute_features_in_parallel(conn, match_ids, workers, shards_per_worker=4):
+    """
+    Split the missing matches into contiguous time shards and compute them in a
+    process pool. Each worker starts from the yearly checkpoint of the engine nearest
+    its shard's first match, so the stored rows are identical to a sequential replay.
+    Checkpoints are kept on disk and reused by later runs until the data before them
+    changes.
+    """
+    match_ids = sorted(match_ids)
+    n_shards = min(workers * shards_per_worker, len(match_ids))
+    shard_size = -(-len(match_ids) // n_shards)
+    shards = [
+        match_ids[i : i + shard_size] for i in range(0, len(match_ids), shard_size)
+    ]
+
+    save_checkpoints(conn, [shard[0] for shard in shards])
+
+    db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        with alive_bar(len(shards), title="Computing features") as bar:
+            # Shards come back in match_id order
+            for rows in executor.map(compute_shard, [db_path] * len(shards), shards):
+                save_features(conn, rows)
+                bar()
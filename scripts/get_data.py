@@ -10,31 +10,16 @@ def get_rankings(num_rankings=10):
     # Get current date
     current_date = datetime.datetime.now()
 
-    # Querying matches in descending order of match_id
-    # Only query matches that are in the past 12 months
-    # Convert match id of format YYYYMMDD_XXXX_XXX to datetime object first to compare to current date
-    query = f"""
-        SELECT *
-        FROM tennis_matches
-        WHERE match_id LIKE '{current_date.year - 1}%'
-            OR match_id LIKE '{current_date.year}%'
-        ORDER BY match_id DESC
+    # Each player's current Elo from player_ratings (see create_elo)
+    # Only players with a match this year or last year are ranked
+    query = """
+        SELECT player_name, elo
+        FROM player_ratings
+        WHERE last_match_id >= ?
     """
-    cursor.execute(query)
-    matches = cursor.fetchall()
-
-    # Looping through matches to get the most recent ELO for each player
-    rankings = {}
-    for match in matches:
-        if match.A_elo == None:
-            match.A_elo = 1500
-        if match.B_elo == None:
-            match.B_elo = 1500
-
-        if match.A_name not in rankings:
-            rankings[match.A_name] = round(match.A_elo, 0)
-        if match.B_name not in rankings:
-            rankings[match.B_name] = round(match.B_elo, 0)
+    cursor.execute(query, (str(current_date.year - 1),))
+    rankings = {player_name: round(elo, 0) for player_name, elo in cursor.fetchall()}
+    conn.close()
 
     sorted_rankings = sorted(rankings.items(), key=lambda x: x[1], reverse=True)
 
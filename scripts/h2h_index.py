@@ -0,0 +1,235 @@
+from bisect import bisect_left
+
+from scripts.conditions import compile_conditions
+from scripts.data_helpers import get_day, simplify_name
+from scripts.match_changes import get_match_changes
+
+# Fields of a stored meeting, in tuple order. The winner and loser are stored as
+# player ids and returned as simplified names by get_meetings
+MEETING_FIELDS = [
+    "match_id",
+    "match_day",
+    "winner",
+    "loser",
+    "surface",
+    "tourney_IOC",
+    "tourney_name",
+    "round",
+    "tourney_level",
+]
+
+# Condition keys and the meeting tuple positions they are compared with
+CONDITION_FIELDS = {
+    "surface": 4,
+    "IOC": 5,
+    "tourney_name": 6,
+    "round": 7,
+    "tourney_level": 8,
+}
+
+
+def get_pair(player_A, player_B):
+    """Key of an unordered pair of players."""
+    return (player_A, player_B) if player_A < player_B else (player_B, player_A)
+
+
+class H2HIndex:
+    """
+    Head-to-head meetings of every pair of players that have played each other.
+
+    Meetings are keyed by the unordered pair of player ids and kept as compact tuples
+    (see MEETING_FIELDS) in match_id order, so the meetings before a match are found by
+    binary search and a head-to-head record costs O(meetings).
+
+    Players are looked up by simplified name and keyed by the id of the players table
+    given with their first match, or by a negative id of the index's own for matches
+    written before player ids.
+
+    A long-lived index is kept up to date with update_from_db, which adds new matches
+    and reloads every meeting from the earliest match changed since the last update,
+    as recorded in the match_changes table.
+    """
+
+    def __init__(self):
+        self.pairs = {}
+        self.player_ids = {}
+        self.player_names = {}
+        self.last_match_id = ""
+        self.last_change_id = 0
+
+    def get_player_id(self, player_name, player_id=None):
+        known_id = self.player_ids.get(player_name)
+        if known_id is None:
+            if player_id is None:
+                player_id = -1 - len(self.player_ids)
+            known_id = self.player_ids[player_name] = player_id
+            self.player_names[known_id] = player_name
+        return known_id
+
+    @classmethod
+    def from_db(cls, conn):
+        index = cls()
+        index.update_from_db(conn)
+        return index
+
+    def update_from_db(self, conn):
+        """
+        Add the matches in tennis_matches newer than any the index has seen, after
+        reloading those from the earliest match inserted, changed or deleted since the
+        last update.
+        """
+        changed_from, self.last_change_id = get_match_changes(conn, self.last_change_id)
+        if changed_from is not None and changed_from <= self.last_match_id:
+            self.remove_from(changed_from)
+
+        cursor = conn.cursor()
+        columns = self.get_columns(cursor)
+        cursor.execute(
+            f"SELECT {', '.join(columns)} FROM tennis_matches "
+            "WHERE match_id > ? AND A_simplified_name IS NOT NULL "
+            "ORDER BY match_id",
+            (self.last_match_id,),
+        )
+        for row in cursor:
+            self.add_match(dict(zip(columns, row)))
+
+    def add_pair_from_db(self, conn, player_A, player_B):
+        """
+        Add every meeting of two players, found through the simplified name indexes,
+        for an index that only needs the pairs it is asked about. Such an index should
+        not be topped up with update_from_db, which only reads newer matches. The
+        caller creates the indexes first (see stats.create_name_indexes), otherwise
+        each pair is a scan of the table.
+        """
+        cursor = conn.cursor()
+        columns = self.get_columns(cursor)
+        cursor.execute(
+            f"SELECT {', '.join(columns)} FROM tennis_matches "
+            "WHERE (A_simplified_name = ? AND B_simplified_name = ?) "
+            "OR (A_simplified_name = ? AND B_simplified_name = ?) "
+            "ORDER BY match_id",
+            (player_A, player_B, player_B, player_A),
+        )
+        for row in cursor:
+            self.add_match(dict(zip(columns, row)))
+
+    @staticmethod
+    def get_columns(cursor):
+        """Columns of tennis_matches read into meetings."""
+        cursor.execute("PRAGMA table_info(tennis_matches)")
+        existing_columns = [column[1] for column in cursor.fetchall()]
+        columns = [
+            "match_id",
+            "A_simplified_name",
+            "B_simplified_name",
+            "surface",
+            "tourney_IOC",
+            "tourney_name",
+            "round",
+            "tourney_level",
+        ]
+        for column in ["match_day", "A_player_id", "B_player_id"]:
+            if column in existing_columns:
+                columns.append(column)
+        return columns
+
+    def remove_from(self, match_id):
+        """Remove the meetings from match_id on."""
+        for pair, meetings in list(self.pairs.items()):
+            del meetings[bisect_left(meetings, (match_id,)) :]
+            if not meetings:
+                del self.pairs[pair]
+        self.last_match_id = max(
+            (meetings[-1][0] for meetings in self.pairs.values()), default=""
+        )
+
+    def add_match(self, match):
+        tourney_name = match["tourney_name"]
+        winner = self.get_player_id(
+            match["A_simplified_name"], match.get("A_player_id")
+        )
+        loser = self.get_player_id(match["B_simplified_name"], match.get("B_player_id"))
+        meeting = (
+            match["match_id"],
+            get_day(match),
+            winner,
+            loser,
+            match["surface"],
+            match["tourney_IOC"],
+            simplify_name(tourney_name) if tourney_name is not None else None,
+            match["round"],
+            match["tourney_level"],
+        )
+
+        meetings = self.pairs.setdefault(get_pair(winner, loser), [])
+        if not meetings or meetings[-1][0] < meeting[0]:
+            meetings.append(meeting)
+        else:
+            # Out of order, or a match being written again
+            i = bisect_left(meetings, (meeting[0],))
+            if i < len(meetings) and meetings[i][0] == meeting[0]:
+                meetings[i] = meeting
+            else:
+                meetings.insert(i, meeting)
+
+        if meeting[0] > self.last_match_id:
+            self.last_match_id = meeting[0]
+
+    def get_meeting_tuples(self, player_A, player_B, match_id=None):
+        """Meeting tuples between two players given by their player ids."""
+        if player_A is None or player_B is None:
+            return []
+        meetings = self.pairs.get(get_pair(player_A, player_B), [])
+        if match_id:
+            meetings = meetings[: bisect_left(meetings, (match_id,))]
+        return meetings
+
+    def get_meetings(self, player_A, player_B, match_id=None):
+        """
+        Meetings between two players, oldest first, as dictionaries with the keys in
+        MEETING_FIELDS. Only meetings before match_id are returned if it is given.
+        """
+        meetings = []
+        for meeting in self.get_meeting_tuples(
+            self.player_ids.get(player_A), self.player_ids.get(player_B), match_id
+        ):
+            meeting = dict(zip(MEETING_FIELDS, meeting))
+            meeting["winner"] = self.player_names[meeting["winner"]]
+            meeting["loser"] = self.player_names[meeting["loser"]]
+            meetings.append(meeting)
+        return meetings
+
+    def get_h2h(self, player_A, player_B, match_id, conditions_list):
+        """
+        Head-to-head record [player_A wins, player_B wins] for every condition, with
+        the same conditions as stats.get_h2h.
+        """
+        player_A = self.player_ids.get(player_A)
+        meetings = self.get_meeting_tuples(
+            player_A, self.player_ids.get(player_B), match_id
+        )
+        plan = compile_conditions(conditions_list)
+        window_starts = plan.get_window_starts(match_id)
+
+        results = []
+        for weeks, indices in plan.conditions:
+            window_start = window_starts[weeks] if weeks is not None else None
+            filters = [
+                (CONDITION_FIELDS[plan.atoms[i][0]], plan.atoms[i][1]) for i in indices
+            ]
+
+            player_A_h2h = 0
+            player_B_h2h = 0
+            for meeting in meetings:
+                if window_start is not None and meeting[1] < window_start:
+                    continue
+                if any(meeting[i] != value for i, value in filters):
+                    continue
+                if meeting[2] == player_A:
+                    player_A_h2h += 1
+                else:
+                    player_B_h2h += 1
+
+            results.append([player_A_h2h, player_B_h2h])
+
+        return results
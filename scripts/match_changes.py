@@ -0,0 +1,39 @@
+def create_match_change_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS match_changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_match_id TEXT NOT NULL
+        )
+        """)
+    conn.commit()
+
+
+def log_match_change(conn, from_match_id):
+    """
+    Record that tennis_matches rows from from_match_id on were inserted, changed or
+    deleted, for long-lived readers such as an H2HIndex to catch up with.
+    """
+    create_match_change_table(conn)
+    conn.cursor().execute(
+        "INSERT INTO match_changes (from_match_id) VALUES (?)", (from_match_id,)
+    )
+    conn.commit()
+
+
+def get_match_changes(conn, after_change_id=0):
+    """
+    Return the earliest match_id changed since after_change_id, or None when nothing
+    changed, and the id of the latest change to pass as after_change_id next time.
+    """
+    create_match_change_table(conn)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT MIN(from_match_id), MAX(change_id) FROM match_changes "
+        "WHERE change_id > ?",
+        (after_change_id,),
+    )
+    from_match_id, last_change_id = cursor.fetchone()
+    if last_change_id is None:
+        return None, after_change_id
+    return from_match_id, last_change_id
@@ -0,0 +1,403 @@
+import numpy as np
+
+from config.config import ELO_CONSTANTS
+from scripts.conditions import compile_conditions
+from scripts.data_helpers import (
+    add_to_variance,
+    get_day,
+    get_games,
+    get_match_day,
+    get_variance,
+    get_window_start,
+    simplify_name,
+)
+
+# Kinds of categorical values stored as integer codes
+CODE_KINDS = [
+    "surface",
+    "tourney_level",
+    "round",
+    "IOC",
+    "tourney_name",
+    "tourney_key",
+    "player",
+]
+
+# Condition keys, the tennis_matches columns they are read from and their code dtype
+CONDITION_COLUMNS = {
+    "surface": ("surface", np.int8),
+    "tourney_level": ("tourney_level", np.int8),
+    "round": ("round", np.int8),
+    "IOC": ("tourney_IOC", np.int16),
+    "tourney_name": ("tourney_name", np.int32),
+    "tourney_key": ("tourney_key", np.int32),
+}
+
+# Condition keys whose Elo change variance is kept as running totals per value. Like
+# the running sums of weeks windows, these can differ from stats.get_elo_variance in
+# the last few digits (see benchmark_stats.VARIANCE_TOLERANCE)
+VARIANCE_KEYS = ["surface", "tourney_level", "round"]
+
+
+class CodeTable:
+    """
+    Integer codes for the categorical values of one PlayerHistory and its prefixes.
+    Codes are only compared within the history that assigned them, so each history
+    owns its table and it is freed along with the history.
+    """
+
+    def __init__(self):
+        self.codes = {kind: {} for kind in CODE_KINDS}
+        self.values = {kind: [] for kind in CODE_KINDS}
+
+    def get_code(self, kind, value):
+        """Return the integer code of a value, assigning the next free code if it is new."""
+        codes = self.codes[kind]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+            self.values[kind].append(value)
+        return code
+
+    def find_code(self, kind, value):
+        """Return the integer code of a value, or -1 if the history does not contain it."""
+        if kind == "tourney_name" and value is not None:
+            value = simplify_name(value)
+        return self.codes[kind].get(value, -1)
+
+
+class PlayerHistory:
+    """
+    Columnar, match_id ordered history of a single player's matches.
+
+    Every column is a NumPy array with one entry per match, seen from the player's
+    side: their Elo after the match, their opponent's Elo, whether they won, integer
+    codes for the categorical columns and the day ordinal of the match.
+
+    Columns that accumulate over the history, such as the running games total, only
+    depend on earlier rows, so they stay valid for every prefix of the history.
+    """
+
+    def __init__(self, player_name, columns, codes, root=None):
+        self.player_name = player_name
+        self.columns = columns
+        self.codes = codes
+        # Full history this one is a prefix of, which owns the cached atom masks
+        self.root = root if root is not None else self
+        self.mask_cache = {}
+        self.serve_rating_index = None
+        self.match_ids = columns["match_id"]
+        self.day = columns["day"]
+        self.elo = columns["elo"]
+        self.opponent_elo = columns["opponent_elo"]
+        self.won = columns["won"]
+        self.opponent = columns["opponent"]
+        self.games = columns["games"]
+        self.cumulative_games = columns["cumulative_games"]
+        self.last_played = columns["last_played"]
+        self.serve_rating = columns["serve_rating"]
+
+    @classmethod
+    def from_matches(cls, player_name, matches):
+        """
+        Build a history from a list of match dictionaries ordered by match_id, such as
+        the one returned by get_all_matches_for_player.
+        """
+        codes = CodeTable()
+        won = [match["A_simplified_name"] == player_name for match in matches]
+        side = ["A" if w else "B" for w in won]
+        other = ["B" if w else "A" for w in won]
+
+        columns = {
+            "match_id": np.array([match["match_id"] for match in matches], dtype=str),
+            "day": np.array([get_day(match) for match in matches], dtype=np.int32),
+            "elo": np.array(
+                [match[f"{s}_elo"] for match, s in zip(matches, side)],
+                dtype=np.float64,
+            ),
+            "opponent_elo": np.array(
+                [match[f"{o}_elo"] for match, o in zip(matches, other)],
+                dtype=np.float64,
+            ),
+            "won": np.array(won, dtype=bool),
+            "opponent": np.array(
+                [
+                    codes.get_code("player", match[f"{o}_simplified_name"])
+                    for match, o in zip(matches, other)
+                ],
+                dtype=np.int32,
+            ),
+            "games": np.array([get_games(match) for match in matches], dtype=np.int32),
+            "serve_rating": np.array(
+                [match.get(f"{s}_avg_serve_rating") for match, s in zip(matches, side)],
+                dtype=np.float64,
+            ),
+        }
+
+        # Games played up to and including each match, and the row of the most recent
+        # match with a games count (-1 before the first one)
+        columns["cumulative_games"] = np.cumsum(columns["games"], dtype=np.int64)
+        columns["last_played"] = np.maximum.accumulate(
+            np.where(columns["games"] > 0, np.arange(len(matches)), -1)
+        ).astype(np.int32)
+
+        for key, (column, dtype) in CONDITION_COLUMNS.items():
+            values = [match.get(column) for match in matches]
+            if key == "tourney_name":
+                values = [simplify_name(v) if v is not None else v for v in values]
+            columns[key] = np.array(
+                [codes.get_code(key, v) for v in values], dtype=dtype
+            )
+
+        # Highest Elo reached up to and including each match
+        columns["peak_elo"] = np.maximum.accumulate(columns["elo"])
+
+        # Running sums of the Elo changes between consecutive matches, so the variance
+        # of any window of matches is a subtraction
+        elo_changes = np.zeros(len(matches), dtype=np.float64)
+        elo_changes[1:] = columns["elo"][:-1] - columns["elo"][1:]
+        columns["cumulative_change"] = np.cumsum(elo_changes)
+        columns["cumulative_change_sq"] = np.cumsum(elo_changes**2)
+
+        # Running [count, mean, M2] of the Elo changes between consecutive matches with
+        # the same value of each VARIANCE_KEYS column, as of each row
+        elos = columns["elo"].tolist()
+        for key in VARIANCE_KEYS:
+            states = np.zeros((len(matches), 3), dtype=np.float64)
+            last_elos = {}
+            totals_by_value = {}
+            for i, value in enumerate(columns[key].tolist()):
+                totals = totals_by_value.setdefault(value, [0, 0.0, 0.0])
+                if value in last_elos:
+                    add_to_variance(totals, last_elos[value] - elos[i])
+                last_elos[value] = elos[i]
+                states[i] = totals
+            columns[f"{key}_variance"] = states
+
+        return cls(player_name, columns, codes)
+
+    def __len__(self):
+        return len(self.match_ids)
+
+    def count_before(self, match_id):
+        """Number of matches in the history played before match_id."""
+        return int(np.searchsorted(self.match_ids, match_id, side="left"))
+
+    def before(self, match_id):
+        """
+        History of the matches played before match_id. The prefix is found by binary
+        search over the match ids and its columns are views, so nothing is copied.
+        """
+        n = self.count_before(match_id)
+        return PlayerHistory(
+            self.player_name,
+            {key: column[:n] for key, column in self.columns.items()},
+            self.codes,
+            self.root,
+        )
+
+    def atom_mask(self, key, value):
+        """
+        Mask of the matches with key == value, for a ConditionPlan atom. Masks are
+        computed once over the full history and sliced for each of its prefixes.
+        """
+        mask_cache = self.root.mask_cache
+        mask = mask_cache.get((key, value))
+        if mask is None:
+            code = self.codes.codes[key].get(value, -1)
+            mask = mask_cache[(key, value)] = self.root.columns[key] == code
+        return mask[: len(self)]
+
+    def serve_rating_rows(self, serve_rating, margin):
+        """
+        Rows whose serve rating is within margin of serve_rating, in ascending order.
+        The full history's ratings are sorted once, so each range is two binary
+        searches and only the rows inside it are touched.
+        """
+        root = self.root
+        if root.serve_rating_index is None:
+            order = np.argsort(root.serve_rating, kind="stable")
+            root.serve_rating_index = (root.serve_rating[order], order)
+
+        low, high = serve_rating - margin, serve_rating + margin
+        if not low <= high:
+            return np.empty(0, dtype=np.intp)
+
+        # Missing ratings are NaN, which sorts after every rating
+        ratings, order = root.serve_rating_index
+        start = np.searchsorted(ratings, low, side="left")
+        end = np.searchsorted(ratings, high, side="right")
+        rows = np.sort(order[start:end])
+        return rows[: np.searchsorted(rows, len(self))]
+
+    def condition_masks(self, plan, match_id, serve_rating_margin=None):
+        """
+        Boolean masks of the matches satisfying each condition of a ConditionPlan, one
+        row per condition, with the same semantics as ConditionPlan.evaluate.
+        """
+        masks = np.ones((len(plan), len(self)), dtype=bool)
+
+        n = self.count_before(match_id)
+        window_starts = [
+            int(np.searchsorted(self.day[:n], start))
+            for start in plan.get_window_starts(match_id)
+        ]
+        atom_masks = [self.atom_mask(key, value) for key, value in plan.atoms]
+
+        for mask, (weeks, indices) in zip(masks, plan.conditions):
+            if weeks is not None:
+                mask[: window_starts[weeks]] = False
+                mask[n:] = False
+            for i in indices:
+                mask &= atom_masks[i]
+
+        if serve_rating_margin is not None:
+            serve_mask = np.zeros(len(self), dtype=bool)
+            serve_mask[self.serve_rating_rows(*serve_rating_margin)] = True
+            masks &= serve_mask
+
+        return masks
+
+    def get_performance_and_record(
+        self, match_id, conditions_list, serve_rating_margin=None
+    ):
+        """
+        Elo performance ratings and win-loss records for every condition, replaying
+        all of them in one sweep over the matches that satisfy at least one condition.
+        """
+        membership = self.condition_masks(
+            compile_conditions(conditions_list), match_id, serve_rating_margin
+        )
+
+        wins = np.count_nonzero(membership & self.won, axis=1).tolist()
+        counts = np.count_nonzero(membership, axis=1).tolist()
+
+        rows = np.flatnonzero(membership.any(axis=0))
+        levels = self.codes.values["tourney_level"]
+        player_elos = [1500] * len(conditions_list)
+        for level, opp_elo, won, active in zip(
+            self.columns["tourney_level"][rows].tolist(),
+            self.opponent_elo[rows].tolist(),
+            self.won[rows].tolist(),
+            membership[:, rows].T.tolist(),
+        ):
+            elo_k = ELO_CONSTANTS[levels[level]]["K"]
+            elo_s = ELO_CONSTANTS[levels[level]]["S"]
+            match_result = 1 if won else 0
+            for i, is_active in enumerate(active):
+                if is_active:
+                    win_prob = 1 / (1 + 10 ** ((opp_elo - player_elos[i]) / elo_s))
+                    player_elos[i] = player_elos[i] + elo_k * (match_result - win_prob)
+
+        return player_elos, [(w, c - w) for w, c in zip(wins, counts)]
+
+    def get_h2h(self, opponent_name, match_id, conditions_list):
+        opponent_mask = self.opponent == self.codes.find_code("player", opponent_name)
+        results = []
+        for mask in self.condition_masks(compile_conditions(conditions_list), match_id):
+            mask &= opponent_mask
+            wins = int(np.count_nonzero(mask & self.won))
+            results.append([wins, int(np.count_nonzero(mask)) - wins])
+        return results
+
+    def get_previous_elo(self, match_id):
+        n = self.count_before(match_id)
+        return self.elo[n - 1].item() if n else 1500
+
+    def get_peak_elo(self, match_id):
+        n = self.count_before(match_id)
+        peak_elo = self.columns["peak_elo"][n - 1] if n else 1500
+        return peak_elo.item() if peak_elo > 1500 else 1500
+
+    def days_since_debut(self, match_id=None):
+        # Mirrors stats.days_since_debut, which measures up to the most recent match
+        # before match_id rather than up to match_id itself
+        n = self.count_before(match_id) if match_id else len(self)
+        return int(self.day[n - 1] - self.day[0]) if n else 0
+
+    def games_since(self, start, n):
+        """Games played in rows start to n - 1, from the running games total."""
+        if start >= n:
+            return 0
+        total = self.cumulative_games[n - 1]
+        if start > 0:
+            total -= self.cumulative_games[start - 1]
+        return int(total)
+
+    def get_fatigue_scores(self, match_id):
+        n = self.count_before(match_id)
+        day = get_match_day(match_id)
+        days = self.day[:n]
+
+        month_start = int(np.searchsorted(days, day - 30, side="left"))
+        week_start = int(np.searchsorted(days, day - 14, side="left"))
+        tournament_start = int(
+            np.searchsorted(self.match_ids[:n], "_".join(match_id.split("_")[:2]) + "_")
+        )
+
+        last_played = int(self.last_played[n - 1]) if n else -1
+        last_match_games = (
+            int(self.games[last_played]) if last_played >= month_start else 0
+        )
+
+        return [
+            last_match_games,
+            self.games_since(max(tournament_start, month_start), n),
+            self.games_since(week_start, n),
+            self.games_since(month_start, n),
+        ]
+
+    def get_window_variance(self, start, n):
+        """Variance of the Elo changes between consecutive matches in rows start to n - 1."""
+        count = n - 1 - start
+        if count <= 1:
+            return 0
+        change_sum = self.columns["cumulative_change"][n - 1]
+        change_sq_sum = self.columns["cumulative_change_sq"][n - 1]
+        change_sum -= self.columns["cumulative_change"][start]
+        change_sq_sum -= self.columns["cumulative_change_sq"][start]
+        return max((change_sq_sum - change_sum**2 / count) / count, 0.0).item()
+
+    def get_bucket_variance(self, key, value, n):
+        """Variance of the Elo changes between the first n matches with key == value."""
+        rows = np.flatnonzero(self.columns[key][:n] == self.codes.find_code(key, value))
+        if not len(rows):
+            return 0
+        count, _, m2 = self.columns[f"{key}_variance"][rows[-1]].tolist()
+        return get_variance(int(count), m2)
+
+    def get_elo_variance(self, match_id, conditions_list):
+        plan = compile_conditions(conditions_list)
+        n = self.count_before(match_id)
+        masks = None
+        results = []
+        for i, (weeks, items) in enumerate(plan.specs):
+            # Weeks windows and single column buckets are read from running totals
+            if weeks is not None and not items:
+                start = int(
+                    np.searchsorted(
+                        self.day[:n], get_window_start(get_match_day(match_id), weeks)
+                    )
+                )
+                results.append(self.get_window_variance(start, n))
+                continue
+            if weeks is None and len(items) == 1 and items[0][0] in VARIANCE_KEYS:
+                results.append(self.get_bucket_variance(*items[0], n))
+                continue
+
+            if masks is None:
+                masks = self.condition_masks(plan, match_id)
+
+            # Changes between consecutive matches, walking from the most recent one
+            elos = self.elo[:n][masks[i, :n]][::-1].tolist()
+            elo_changes = [elo - previous for previous, elo in zip(elos, elos[1:])]
+
+            if len(elo_changes) > 1:
+                mean = sum(elo_changes) / len(elo_changes)
+                results.append(
+                    sum([(elo - mean) ** 2 for elo in elo_changes]) / len(elo_changes)
+                )
+            else:
+                results.append(0)
+
+        return results
@@ -0,0 +1,190 @@
+import pickle
+import zlib
+from datetime import date, timedelta
+
+from alive_progress import alive_bar
+
+from scripts.feature_engine import PlayerState, iterate_matches
+
+# Bump whenever PlayerState changes, so snapshots pickled by the old code are dropped
+SNAPSHOT_VERSION = 1
+
+# Newest snapshots kept for each player
+SNAPSHOTS_PER_PLAYER = 4
+
+
+def create_snapshot_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_snapshots (
+            player_name TEXT NOT NULL,
+            as_of TEXT NOT NULL,
+            state BLOB NOT NULL,
+            snapshot_version INTEGER NOT NULL,
+            PRIMARY KEY (player_name, as_of)
+        )
+        """)
+    conn.commit()
+
+
+def delete_player_snapshots(conn, from_match_id=""):
+    """
+    Delete every snapshot that includes from_match_id or a later match, and every
+    snapshot pickled by another version. With no match id every snapshot is deleted.
+    """
+    create_snapshot_table(conn)
+    conn.execute(
+        "DELETE FROM player_snapshots WHERE as_of > ? OR snapshot_version != ?",
+        (from_match_id, SNAPSHOT_VERSION),
+    )
+    conn.commit()
+
+
+def dump_state(state):
+    return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_state(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+def load_snapshot(conn, player_name, as_of):
+    row = conn.execute(
+        "SELECT state FROM player_snapshots WHERE player_name = ? AND as_of = ?",
+        (player_name, as_of),
+    ).fetchone()
+    return load_state(row[0])
+
+
+def get_snapshot_date(day=None):
+    """The Monday on or before day (today by default) as a YYYYMMDD string."""
+    if day is None:
+        day = date.today()
+    return (day - timedelta(days=day.weekday())).strftime("%Y%m%d")
+
+
+def get_player_state(conn, player_name, match_id=None):
+    """
+    Return the PlayerState of a player as of match_id, built from every match of theirs
+    before it, or from all their matches when match_id is None.
+
+    The state starts from the player's nearest snapshot at or before match_id, so only
+    the matches played since that snapshot are read and replayed.
+    """
+    create_snapshot_table(conn)
+    bound = "" if match_id is None else " AND as_of <= ?"
+    parameters = [player_name, SNAPSHOT_VERSION]
+    if match_id is not None:
+        parameters.append(match_id)
+    row = conn.execute(
+        "SELECT as_of, state FROM player_snapshots "
+        f"WHERE player_name = ? AND snapshot_version = ?{bound} "
+        "ORDER BY as_of DESC LIMIT 1",
+        parameters,
+    ).fetchone()
+
+    if row is None:
+        as_of, state = "", PlayerState(player_name)
+    else:
+        as_of, state = row[0], load_state(row[1])
+
+    bound = "" if match_id is None else " AND match_id < ?"
+    parameters = [player_name, player_name, as_of]
+    if match_id is not None:
+        parameters.append(match_id)
+    for m in iterate_matches(
+        conn,
+        "SELECT * FROM tennis_matches "
+        "WHERE (A_simplified_name = ? OR B_simplified_name = ?) "
+        f"AND match_id >= ?{bound} ORDER BY match_id",
+        parameters,
+    ):
+        state.add_match(m)
+
+    return state
+
+
+def update_player_snapshots(conn, as_of=None, keep=SNAPSHOTS_PER_PLAYER):
+    """
+    Snapshot, as of as_of (by default the most recent Monday), the state of every
+    player who has played since their latest snapshot. Each player's state continues
+    from their latest snapshot, so only the matches since the previous run are
+    replayed. Only the newest keep snapshots of each player are kept.
+
+    Returns the number of snapshots written.
+    """
+    create_snapshot_table(conn)
+    conn.execute(
+        "DELETE FROM player_snapshots WHERE snapshot_version != ?", (SNAPSHOT_VERSION,)
+    )
+    if as_of is None:
+        as_of = get_snapshot_date()
+
+    latest = dict(
+        conn.execute(
+            "SELECT player_name, MAX(as_of) FROM player_snapshots "
+            "WHERE as_of <= ? GROUP BY player_name",
+            (as_of,),
+        )
+    )
+    # Every run snapshots each player who played since their latest snapshot, so
+    # players with snapshots have no unsnapshotted matches before the latest run.
+    # Invalidation can delete every snapshot of a player though, so the scan starts
+    # early enough for those players to be rebuilt from their first match
+    since = max(latest.values(), default="")
+    unsnapshotted = conn.execute(
+        "SELECT MIN(match_id) FROM tennis_matches WHERE match_id < ? AND ("
+        "A_simplified_name NOT IN (SELECT player_name FROM player_snapshots "
+        "WHERE as_of <= ?) OR B_simplified_name NOT IN ("
+        "SELECT player_name FROM player_snapshots WHERE as_of <= ?))",
+        (since, as_of, as_of),
+    ).fetchone()[0]
+    if unsnapshotted is not None:
+        since = unsnapshotted
+
+    query = (
+        "SELECT * FROM tennis_matches WHERE match_id >= ? AND match_id < ? "
+        "ORDER BY match_id"
+    )
+    n_matches = conn.execute(
+        "SELECT COUNT(*) FROM tennis_matches WHERE match_id >= ? AND match_id < ?",
+        (since, as_of),
+    ).fetchone()[0]
+
+    states = {}
+    with alive_bar(n_matches, title="Updating player snapshots") as bar:
+        for m in iterate_matches(conn, query, (since, as_of)):
+            for player_name in [m["A_simplified_name"], m["B_simplified_name"]]:
+                snapshot_as_of = latest.get(player_name)
+                if snapshot_as_of is not None and m["match_id"] < snapshot_as_of:
+                    continue
+
+                if player_name not in states:
+                    if snapshot_as_of is not None:
+                        states[player_name] = load_snapshot(
+                            conn, player_name, snapshot_as_of
+                        )
+                    else:
+                        states[player_name] = PlayerState(player_name)
+
+                states[player_name].add_match(m)
+            bar()
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO player_snapshots VALUES (?, ?, ?, ?)",
+        [
+            (player_name, as_of, dump_state(state), SNAPSHOT_VERSION)
+            for player_name, state in states.items()
+        ],
+    )
+    conn.executemany(
+        """
+        DELETE FROM player_snapshots WHERE player_name = ? AND as_of NOT IN (
+            SELECT as_of FROM player_snapshots WHERE player_name = ?
+            ORDER BY as_of DESC LIMIT ?
+        )
+        """,
+        [(player_name, player_name, keep) for player_name in states],
+    )
+    conn.commit()
+
+    return len(states)
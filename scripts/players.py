@@ -0,0 +1,46 @@
+from scripts.data_helpers import simplify_name
+
+
+def create_player_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS players (
+            player_id INTEGER PRIMARY KEY,
+            simplified_name TEXT UNIQUE NOT NULL
+        )
+        """)
+    conn.commit()
+
+
+def get_player_ids(conn):
+    """Return {simplified player name: player_id} for every known player."""
+    create_player_table(conn)
+    return dict(conn.execute("SELECT simplified_name, player_id FROM players"))
+
+
+def add_player_ids(conn, player_names):
+    """
+    Return the player_id of each player name, adding the players the table has not
+    seen yet. Ids are dense integers from 1, and names are matched by their simplified
+    form, so spellings that simplify to the same name share an id.
+    """
+    player_ids = get_player_ids(conn)
+    simplified_names = [
+        simplify_name(name) if name is not None else None for name in player_names
+    ]
+
+    new_names = sorted(
+        {
+            name
+            for name in simplified_names
+            if name is not None and name not in player_ids
+        }
+    )
+    if new_names:
+        conn.executemany(
+            "INSERT INTO players (simplified_name) VALUES (?)",
+            [(name,) for name in new_names],
+        )
+        conn.commit()
+        player_ids = get_player_ids(conn)
+
+    return [player_ids.get(name) for name in simplified_names]
@@ -18,7 +18,12 @@ sys.path.append(parent_dir)
 
 from config.config import STAT_LABELS
 from scripts.data_helpers import simplify_name
-from scripts.stats import get_all_matches_for_player, get_match_stats
+from scripts.feature_engine import FeatureEngine
+from scripts.feature_selection import ALL_FEATURES, SWAP_PERMUTATION, FeatureSelection
+from scripts.feature_store import load_features
+from scripts.player_snapshots import get_player_state
+from scripts.stats import create_name_indexes
+from scripts.tournaments import get_tourney_keys
 
 labels = STAT_LABELS
 
@@ -43,8 +48,51 @@ def find_latest_transformer():
     return os.path.join(transformer_dir, transformers[0])
 
 
-def prepare_data(df, conn):
-    player_match_dict = {}
+def load_feature_selection(model_path):
+    """
+    Load the feature selection saved alongside a model, selecting every stat for
+    models saved before selections were recorded.
+    """
+    selection_path = os.path.join(
+        "models/feature_selection",
+        os.path.basename(model_path)
+        .replace("NN_model_", "NN_features_")
+        .replace(".sav", ".json"),
+    )
+    if not os.path.exists(selection_path):
+        return ALL_FEATURES
+    return FeatureSelection.load(selection_path)
+
+
+def get_fixture_state(conn, player_states, player_name, match_id):
+    """
+    Return the name and the PlayerState as of match_id of a fixture's player, using
+    the closest name in the database for players without earlier matches. States are
+    loaded from the player snapshots and cached in player_states.
+    """
+    key = (player_name, match_id)
+    if key not in player_states:
+        state = get_player_state(conn, player_name, match_id)
+        if not state.match_ids:
+            # If no matches found, find the best match name in the database.
+            state = get_player_state(
+                conn, find_best_name_match(player_name, conn), match_id
+            )
+        player_states[key] = state
+    state = player_states[key]
+    return state.player_name, state
+
+
+def prepare_data(df, conn, selection=ALL_FEATURES):
+    player_states = {}
+    engine = FeatureEngine()
+    # Only the meetings of the fixtures' players are loaded into the H2H index, each
+    # pair through the simplified name indexes
+    h2h_pairs = set()
+    create_name_indexes(conn)
+    # Fixtures already in tennis_matches can reuse their stored features
+    stored_features = load_features(conn, df["match_id"])
+    tourney_keys = get_tourney_keys(conn)
     X = {"AB": [], "BA": []}
     stats_list = []  # Added to store all calculated stats
 
@@ -59,63 +107,41 @@ def prepare_data(df, conn):
             if row["p"] != "" and pd.notnull(row["p"]):
                 continue
 
-            player_A = simplify_name(row["A_name"])
-            player_B = simplify_name(row["B_name"])
-
-            if player_A not in player_match_dict:
-                player_A_matches = get_all_matches_for_player(player_A, conn)
-                if (
-                    not player_A_matches
-                ):  # If no matches found, find the best match name in the database.
-                    player_A = find_best_name_match(player_A, conn)
-                    player_A_matches = get_all_matches_for_player(player_A, conn)
-                player_match_dict[player_A] = player_A_matches
-            else:
-                player_A_matches = player_match_dict[player_A]
-
-            if player_B not in player_match_dict:
-                player_B_matches = get_all_matches_for_player(player_B, conn)
-                if (
-                    not player_B_matches
-                ):  # If no matches found, find the best match name in the database.
-                    player_B = find_best_name_match(player_B, conn)
-                    player_B_matches = get_all_matches_for_player(player_B, conn)
-                player_match_dict[player_B] = player_B_matches
-            else:
-                player_B_matches = player_match_dict[player_B]
-
-            player_A_matches = [
-                player_A_matches[i]
-                for i in range(len(player_A_matches))
-                if player_A_matches[i]["match_id"] < row["match_id"]
-            ]
-
-            player_B_matches = [
-                player_B_matches[i]
-                for i in range(len(player_B_matches))
-                if player_B_matches[i]["match_id"] < row["match_id"]
-            ]
-
-            data_list = get_match_stats(
-                row, player_A, player_B, player_A_matches, player_B_matches
+            player_A, player_A_state = get_fixture_state(
+                conn, player_states, simplify_name(row["A_name"]), row["match_id"]
             )
+            player_B, player_B_state = get_fixture_state(
+                conn, player_states, simplify_name(row["B_name"]), row["match_id"]
+            )
+            engine.players = {player_A: player_A_state, player_B: player_B_state}
+            if (player_A, player_B) not in h2h_pairs:
+                engine.h2h_index.add_pair_from_db(conn, player_A, player_B)
+                h2h_pairs.update([(player_A, player_B), (player_B, player_A)])
+
+            # Fixtures of known tournaments are compared with the histories by key
+            if row["tourney_name"] is not None:
+                row["tourney_key"] = tourney_keys.get(
+                    simplify_name(row["tourney_name"])
+                )
+
+            stored = stored_features.get(row["match_id"])
+            if stored is not None and stored[:2] == (player_A, player_B):
+                data_list = stored[2].tolist()
+            else:
+                data_list = engine.get_match_stats(row, player_A, player_B, selection)
 
             X["AB"].append(data_list)
             stats_list.append({"index": index, "stats": data_list})
 
-            # Swap player A and player B for BA data
-            row_swapped = swap_players(row)
-            data_list_swapped = get_match_stats(
-                row_swapped, player_B, player_A, player_B_matches, player_A_matches
-            )
-
-            X["BA"].append(data_list_swapped)
-
             bar()
 
-    # Convert lists to np.array
+    # Convert lists to np.array, the BA data being the AB data with players swapped
     X["AB"] = np.array(X["AB"])
-    X["BA"] = np.array(X["BA"])
+    X["BA"] = X["AB"][:, SWAP_PERMUTATION] if len(X["AB"]) else np.array([])
+
+    # Keep the columns the model takes as input
+    if len(X["AB"]):
+        X = {key: value[:, selection.indices] for key, value in X.items()}
 
     return X, stats_list  # Return stats_list
 
@@ -160,18 +186,6 @@ def load_data():
     return df
 
 
-def swap_players(row):
-    # Swap player A and player B
-    row_swapped = row.copy()
-    player_A_columns = [col for col in row.index if col.startswith("A_")]
-    player_B_columns = [col for col in row.index if col.startswith("B_")]
-
-    for col_A, col_B in zip(player_A_columns, player_B_columns):
-        row_swapped[col_A], row_swapped[col_B] = row[col_B], row[col_A]
-
-    return row_swapped
-
-
 def save_predictions(df, predictions, stats_list):
     data_path = "data/predictions.xlsx"
 
@@ -205,6 +219,7 @@ def predict_main():
     model = load_model(latest_model_path)
     latest_transformer_path = find_latest_transformer()
     NN_transformer = joblib.load(latest_transformer_path)
+    selection = load_feature_selection(latest_model_path)
 
     print("Models loaded")
 
@@ -212,7 +227,7 @@ def predict_main():
 
     df = load_data()
 
-    X, stats_list = prepare_data(df, conn)  # Receive stats_list
+    X, stats_list = prepare_data(df, conn, selection)  # Receive stats_list
 
     print("Data loaded")
 
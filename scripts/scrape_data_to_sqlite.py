@@ -1060,9 +1060,11 @@ def worker_thread(task_queue, position_queue, db_file, overwrite=True):
         sleep(3)
 
     database_lock = True
-    write_to_db(c, conn, total_matches, overwrite=overwrite)
-    write_to_pd(total_fixtures)
-    database_lock = False
+    try:
+        write_to_db(c, conn, total_matches, overwrite=overwrite)
+        write_to_pd(total_fixtures)
+    finally:
+        database_lock = False
 
 
 def scrape_data_to_sqlite(
@@ -1095,7 +1097,9 @@ def scrape_data_to_sqlite(
                 A_service_points_won REAL, A_return_points_won REAL, A_total_points_won REAL,
                 B_return_rating REAL, B_1st_serve_return_points_won REAL, B_2nd_serve_return_points_won REAL,
                 B_break_points_converted REAL, B_return_games_played INTEGER, B_service_points_won REAL,
-                B_return_points_won REAL, B_total_points_won REAL, match_link TEXT
+                B_return_points_won REAL, B_total_points_won REAL, match_link TEXT, match_day INTEGER,
+                total_games INTEGER, tourney_key INTEGER, A_player_id INTEGER,
+                B_player_id INTEGER
             );
             """
             )
@@ -1,11 +1,15 @@
 import math
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 from config.config import ELO_CONSTANTS
-from scripts.data_helpers import simplify_name
+from scripts.conditions import compile_conditions
+from scripts.data_helpers import get_day, get_games, get_match_day
+from scripts.feature_selection import ALL_FEATURES, STAT_FAMILIES
+from scripts.h2h_index import H2HIndex
+from scripts.player_history import PlayerHistory
 
 
 def get_quarters_since_played(player_name, match_id, conn):
@@ -105,7 +109,8 @@ def get_h2h(player_names, match_id, matches, conditions_list):
     Args:
     player_names (list): List of two players' names [player_A_simplified_name, player_B_simplified_name]
     match_id (str): Match ID to stop calculations before this match (exclusive).
-    matches (list): A list of dictionaries where each dictionary represents a tennis match.
+    matches (list): A list of dictionaries where each dictionary represents a tennis match,
+                    or an H2HIndex of every meeting between players.
     conditions_list (list): A list of dictionaries where each dictionary represents a condition.
                             Possible keys in the dictionary include:
                             - weeks: Number of weeks before the match_id.
@@ -118,60 +123,15 @@ def get_h2h(player_names, match_id, matches, conditions_list):
     list: A list of head-to-head records for each condition provided in the conditions_list.
           The order of the records in the list corresponds to the order of conditions in the conditions_list.
     """
-    results = []
-    for condition in conditions_list:
-        weeks = condition.get("weeks")
-        surface = condition.get("surface")
-        IOC = condition.get("IOC")
-        tourney_name = condition.get("tourney_name")
-        round_ = condition.get("round")
-        tourney_level = condition.get("tourney_level")
-
-        filtered_matches = matches.copy()
-
-        if weeks is not None:
-            if match_id:
-                date_obj = datetime.strptime(match_id[:8], "%Y%m%d")
-            else:
-                date_obj = datetime.now()
-            prior_date_obj = date_obj - timedelta(days=weeks * 7)
-            prior_date_string = prior_date_obj.strftime("%Y%m%d")
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["match_id"] > prior_date_string
-                and match["match_id"] < match_id
-            ]
-
-        if surface is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["surface"] == surface
-            ]
-
-        if IOC is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["tourney_IOC"] == IOC
-            ]
-
-        if tourney_name is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if simplify_name(match["tourney_name"]) == simplify_name(tourney_name)
-            ]
-
-        if round_ is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["round"] == round_
-            ]
-
-        if tourney_level is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["tourney_level"] == tourney_level
-            ]
+    if isinstance(matches, H2HIndex):
+        return matches.get_h2h(*player_names, match_id, conditions_list)
+    if isinstance(matches, PlayerHistory):
+        return matches.get_h2h(player_names[1], match_id, conditions_list)
 
+    results = []
+    for filtered_matches in compile_conditions(conditions_list).filter(
+        matches, match_id
+    ):
         player_A_h2h = 0
         player_B_h2h = 0
         for match in filtered_matches:
@@ -192,6 +152,9 @@ def get_h2h(player_names, match_id, matches, conditions_list):
 
 
 def get_previous_elo(player_name, match_id, matches):
+    if isinstance(matches, PlayerHistory):
+        return matches.get_previous_elo(match_id)
+
     # Sort matches by match_id, with the most recent match first
     matches = sorted(matches, key=lambda k: k["match_id"], reverse=True)
 
@@ -235,17 +198,82 @@ def get_all_matches_for_player(player_name, conn):
     return matches
 
 
-def get_win_loss_record(
+def create_name_indexes(conn):
+    """
+    Index the simplified name columns, so a player's matches are found by two index
+    lookups rather than a scan of the table. Rewriting the table drops the indexes, so
+    they are created again whenever they are missing.
+    """
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS tennis_matches_A_simplified_name "
+        "ON tennis_matches (A_simplified_name)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS tennis_matches_B_simplified_name "
+        "ON tennis_matches (B_simplified_name)"
+    )
+    conn.commit()
+
+
+def get_all_matches_for_players(player_names, conn, chunk_size=400):
+    """
+    Return {player name: their matches}, as get_all_matches_for_player returns them,
+    for many players at once.
+
+    Players are fetched chunk_size at a time with one indexed query per chunk. With
+    player_names None, the whole table is read in one ordered scan and every player's
+    matches are returned. A match between two players appears in both their lists as
+    the same dictionary.
+    """
+    if player_names is None:
+        queries = [("SELECT * FROM tennis_matches ORDER BY match_id", [], None)]
+    else:
+        create_name_indexes(conn)
+        player_names = list(dict.fromkeys(player_names))
+        queries = []
+        for i in range(0, len(player_names), chunk_size):
+            chunk = player_names[i : i + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            queries.append(
+                (
+                    "SELECT * FROM tennis_matches "
+                    f"WHERE A_simplified_name IN ({placeholders}) "
+                    f"OR B_simplified_name IN ({placeholders}) ORDER BY match_id",
+                    chunk + chunk,
+                    set(chunk),
+                )
+            )
+
+    histories = {} if player_names is None else {name: [] for name in player_names}
+    cursor = conn.cursor()
+    for query, parameters, chunk in queries:
+        cursor.execute(query, parameters)
+        columns = [column[0] for column in cursor.description]
+        for row in cursor:
+            match = dict(zip(columns, row))
+            for player_name in [match["A_simplified_name"], match["B_simplified_name"]]:
+                # A match with an opponent in another chunk is read with both chunks
+                if chunk is None:
+                    histories.setdefault(player_name, []).append(match)
+                elif player_name in chunk:
+                    histories[player_name].append(match)
+
+    return histories
+
+
+def get_performance_and_record(
     player_name, match_id, matches, conditions_list, serve_rating_margin=None
 ):
     """
-    Get win-loss records for a tennis player based on different conditions.
+    Calculate the Elo performance rating and the win-loss record of a tennis player for
+    every condition in a single pass over their matches.
 
     Args:
     player_name (str): Name of the player.
     match_id (str): Match ID to stop calculations before this match (exclusive).
-    matches (list): A list of dictionaries where each dictionary represents a tennis match.
-                    The dictionary should contain the following keys:
+    matches (list): A list of dictionaries where each dictionary represents a tennis match,
+                    or a PlayerHistory of the player.
+                    The dictionaries should contain the following keys:
                     - match_id (str): Unique identifier for the match.
                     - A_simplified_name (str): Name of player A.
                     - A_elo (int): Elo rating for player A.
@@ -253,9 +281,9 @@ def get_win_loss_record(
                     - B_elo (int): Elo rating for player B.
                     - tourney_name (str): Name of the tournament.
                     - tourney_IOC (str): International Olympic Committee country code for the tournament.
+                    - tourney_level (str): Level of the tournament (e.g. 'G', 'M', 'F').
                     - surface (str): Surface type (e.g. 'grass', 'clay', 'hard').
                     - round (str): Round of the match (e.g. 'F', 'SF', 'QF', 'R32').
-                    - winner_name (str): Name of the winner.
     conditions_list (list): A list of dictionaries where each dictionary represents a condition.
                             Possible keys in the dictionary include:
                             - weeks: Number of weeks before the match_id.
@@ -263,72 +291,31 @@ def get_win_loss_record(
                             - IOC: International Olympic Committee country code.
                             - tourney_name: Name of the tournament.
                             - round: Round of the match (e.g. 'F', 'SF', 'QF', 'R32').
+                            - tourney_level: Level of the tournament (e.g. 'G', 'M', 'F').
+    serve_rating_margin (tuple): Optional (serve_rating, margin) the player's average serve
+                                 rating must be within.
 
     Returns:
-    list: A list of tuples (wins, losses) for each condition provided in the conditions_list.
-          The order of the tuples in the list corresponds to the order of conditions in the conditions_list.
+    tuple: A list of Elo performance ratings and a list of tuples (wins, losses), each in the
+           order of the conditions in the conditions_list.
     """
+    if isinstance(matches, PlayerHistory):
+        return matches.get_performance_and_record(
+            match_id, conditions_list, serve_rating_margin
+        )
 
-    results = []
-    for condition in conditions_list:
-        weeks = condition.get("weeks")
-        surface = condition.get("surface")
-        IOC = condition.get("IOC")
-        tourney_name = condition.get("tourney_name")
-        round_ = condition.get("round")
-        tourney_level = condition.get("tourney_level")
-
-        filtered_matches = matches.copy()
-
-        if weeks is not None:
-            if match_id:
-                date_obj = datetime.strptime(match_id[:8], "%Y%m%d")
-            else:
-                date_obj = datetime.now()
-            prior_date_obj = date_obj - timedelta(days=weeks * 7)
-            prior_date_string = prior_date_obj.strftime("%Y%m%d")
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["match_id"] > prior_date_string
-                and match["match_id"] < match_id
-            ]
-
-        if surface is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["surface"] == surface
-            ]
-
-        if IOC is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["tourney_IOC"] == IOC
-            ]
-
-        if tourney_name is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if simplify_name(match["tourney_name"]) == simplify_name(tourney_name)
-            ]
-
-        if round_ is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["round"] == round_
-            ]
-
-        if tourney_level is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["tourney_level"] == tourney_level
-            ]
+    plan = compile_conditions(conditions_list)
+    window_starts = plan.get_window_starts(match_id)
+
+    player_elos = [1500] * len(plan)
+    wins = [0] * len(plan)
+    losses = [0] * len(plan)
 
+    for match in matches:
         if serve_rating_margin is not None:
             serve_rating, margin = serve_rating_margin
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if (
+            if not (
+                (
                     serve_rating - margin
                     <= match["A_avg_serve_rating"]
                     <= serve_rating + margin
@@ -340,25 +327,51 @@ def get_win_loss_record(
                     <= serve_rating + margin
                     and player_name == match["B_simplified_name"]
                 )
-            ]
-
-        wins = len(
-            [
-                match
-                for match in filtered_matches
-                if match["A_simplified_name"] == player_name
-            ]
-        )
-        losses = len(
-            [
-                match
-                for match in filtered_matches
-                if match["A_simplified_name"] != player_name
-            ]
-        )
-        results.append((wins, losses))
+            ):
+                continue
 
-    return results
+        if match["A_simplified_name"] == player_name:
+            opp_elo = match["B_elo"]
+            match_result = 1
+        else:
+            opp_elo = match["A_elo"]
+            match_result = 0
+
+        elo_constants = None
+        for i, satisfied in enumerate(plan.evaluate(match, match_id, window_starts)):
+            if not satisfied:
+                continue
+
+            if elo_constants is None:
+                elo_constants = ELO_CONSTANTS[match["tourney_level"]]
+            elo_k = elo_constants["K"]
+            elo_s = elo_constants["S"]
+            win_prob = 1 / (1 + 10 ** ((opp_elo - player_elos[i]) / elo_s))
+            player_elos[i] = player_elos[i] + elo_k * (match_result - win_prob)
+
+            if match_result:
+                wins[i] += 1
+            else:
+                losses[i] += 1
+
+    return player_elos, list(zip(wins, losses))
+
+
+def get_win_loss_record(
+    player_name, match_id, matches, conditions_list, serve_rating_margin=None
+):
+    """
+    Get win-loss records for a tennis player based on different conditions.
+
+    See get_performance_and_record for the arguments.
+
+    Returns:
+    list: A list of tuples (wins, losses) for each condition provided in the conditions_list.
+          The order of the tuples in the list corresponds to the order of conditions in the conditions_list.
+    """
+    return get_performance_and_record(
+        player_name, match_id, matches, conditions_list, serve_rating_margin
+    )[1]
 
 
 def get_elo_performance(
@@ -367,132 +380,24 @@ def get_elo_performance(
     """
     Calculate the Elo performance rating for a tennis player based on different conditions.
 
-    Args:
-    player_name (str): Name of the player.
-    match_id (str): Match ID to stop calculations before this match (exclusive).
-    matches (list): A list of dictionaries where each dictionary represents a tennis match.
-                    The dictionary should contain the following keys:
-                    - match_id (str): Unique identifier for the match.
-                    - A_simplified_name (str): Name of player A.
-                    - A_elo (int): Elo rating for player A.
-                    - B_simplified_name (str): Name of player B.
-                    - B_elo (int): Elo rating for player B.
-                    - tourney_name (str): Name of the tournament.
-                    - tourney_IOC (str): International Olympic Committee country code for the tournament.
-                    - tourney_level (str): Level of the tournament (e.g. 'G', 'M', 'F').
-                    - surface (str): Surface type (e.g. 'grass', 'clay', 'hard').
-                    - round (str): Round of the match (e.g. 'F', 'SF', 'QF', 'R32').
-                    - winner_name (str): Name of the winner.
-    conditions_list (list): A list of dictionaries where each dictionary represents a condition.
-                            Possible keys in the dictionary include:
-                            - weeks: Number of weeks before the match_id.
-                            - surface: Surface type (e.g. 'grass', 'clay', 'hard').
-                            - IOC: International Olympic Committee country code.
-                            - tourney_name: Name of the tournament.
-                            - round: Round of the match (e.g. 'F', 'SF', 'QF', 'R32').
+    See get_performance_and_record for the arguments.
 
     Returns:
     list: A list of Elo performance ratings for each condition provided in the conditions_list.
           The order of the ratings in the list corresponds to the order of conditions in the conditions_list.
     """
-    results = []
-    for condition in conditions_list:
-        weeks = condition.get("weeks")
-        surface = condition.get("surface")
-        IOC = condition.get("IOC")
-        tourney_name = condition.get("tourney_name")
-        round_ = condition.get("round")
-        tourney_level = condition.get("tourney_level")
-
-        filtered_matches = matches.copy()
-
-        if weeks is not None:
-            if match_id:
-                date_obj = datetime.strptime(match_id[:8], "%Y%m%d")
-            else:
-                date_obj = datetime.now()
-            prior_date_obj = date_obj - timedelta(days=weeks * 7)
-            prior_date_string = prior_date_obj.strftime("%Y%m%d")
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["match_id"] > prior_date_string
-                and match["match_id"] < match_id
-            ]
-
-        if surface is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["surface"] == surface
-            ]
-
-        if IOC is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["tourney_IOC"] == IOC
-            ]
-
-        if tourney_name is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if simplify_name(match["tourney_name"]) == simplify_name(tourney_name)
-            ]
-
-        if round_ is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["round"] == round_
-            ]
-
-        if tourney_level is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["tourney_level"] == tourney_level
-            ]
-
-        if serve_rating_margin is not None:
-            serve_rating, margin = serve_rating_margin
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if (
-                    serve_rating - margin
-                    <= match["A_avg_serve_rating"]
-                    <= serve_rating + margin
-                    and player_name == match["A_simplified_name"]
-                )
-                or (
-                    serve_rating - margin
-                    <= match["B_avg_serve_rating"]
-                    <= serve_rating + margin
-                    and player_name == match["B_simplified_name"]
-                )
-            ]
-
-        player_initial_elo = 1500
-        player_elo = player_initial_elo
-        if len(filtered_matches) == 0:
-            results.append(player_initial_elo)
-        else:
-            for match in filtered_matches:
-                tourney_level = match["tourney_level"]
-                elo_k = ELO_CONSTANTS[tourney_level]["K"]
-                elo_s = ELO_CONSTANTS[tourney_level]["S"]
-                if match["A_simplified_name"] == player_name:
-                    opp_elo = match["B_elo"]
-                    match_result = 1
-                else:
-                    opp_elo = match["A_elo"]
-                    match_result = 0
-                win_prob = 1 / (1 + 10 ** ((opp_elo - player_elo) / elo_s))
-                player_elo = player_elo + elo_k * (match_result - win_prob)
-            results.append(player_elo)
-    return results
+    return get_performance_and_record(
+        player_name, match_id, matches, conditions_list, serve_rating_margin
+    )[0]
 
 
 def get_peak_elo(player_name, match_id, matches):
     """
     Calculate the peak Elo performance rating for a tennis player.
     """
+    if isinstance(matches, PlayerHistory):
+        return matches.get_peak_elo(match_id)
+
     player_peak_elo = 1500
     player_elo = player_peak_elo
 
@@ -518,80 +423,36 @@ def days_since_debut(player_name, match_id, matches):
     """
     Calculate the number of years since a player's debut match.
     """
-    match_date = datetime.strptime(match_id[:8], "%Y%m%d")
-    player_debut = match_date
+    if isinstance(matches, PlayerHistory):
+        return matches.days_since_debut(match_id)
+
+    match_day = get_match_day(match_id)
+    player_debut = match_day
     for match in matches:
         if (
             match["A_simplified_name"] == player_name
             or match["B_simplified_name"] == player_name
         ):
-            match_date = datetime.strptime(match["match_id"][:8], "%Y%m%d")
-            if match_date < player_debut:
-                player_debut = match_date
-    return (match_date - player_debut).days
+            match_day = get_day(match)
+            if match_day < player_debut:
+                player_debut = match_day
+    return match_day - player_debut
 
 
 def get_elo_variance(player_name, match_id, matches, conditions_list):
     """
     Calculate the variance of a player's elo gains/losses.
     """
+    if isinstance(matches, PlayerHistory):
+        return matches.get_elo_variance(match_id, conditions_list)
+
     # Sort matches by match_id, with the most recent match first
     matches = sorted(matches, key=lambda k: k["match_id"], reverse=True)
 
     results = []
-    for condition in conditions_list:
-        weeks = condition.get("weeks")
-        surface = condition.get("surface")
-        IOC = condition.get("IOC")
-        tourney_name = condition.get("tourney_name")
-        round_ = condition.get("round")
-        tourney_level = condition.get("tourney_level")
-
-        filtered_matches = matches.copy()
-
-        if weeks is not None:
-            if match_id:
-                date_obj = datetime.strptime(match_id[:8], "%Y%m%d")
-            else:
-                date_obj = datetime.now()
-            prior_date_obj = date_obj - timedelta(days=weeks * 7)
-            prior_date_string = prior_date_obj.strftime("%Y%m%d")
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["match_id"] > prior_date_string
-                and match["match_id"] < match_id
-            ]
-
-        if surface is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["surface"] == surface
-            ]
-
-        if IOC is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["tourney_IOC"] == IOC
-            ]
-
-        if tourney_name is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if simplify_name(match["tourney_name"]) == simplify_name(tourney_name)
-            ]
-
-        if round_ is not None:
-            filtered_matches = [
-                match for match in filtered_matches if match["round"] == round_
-            ]
-
-        if tourney_level is not None:
-            filtered_matches = [
-                match
-                for match in filtered_matches
-                if match["tourney_level"] == tourney_level
-            ]
-
+    for filtered_matches in compile_conditions(conditions_list).filter(
+        matches, match_id
+    ):
         elo_changes = []
         previous_elo = 0
 
@@ -610,14 +471,9 @@ def get_elo_variance(player_name, match_id, matches, conditions_list):
 
         # calculate variance
         if len(elo_changes) > 1:
+            mean = sum(elo_changes) / len(elo_changes)
             results.append(
-                sum(
-                    [
-                        (elo - sum(elo_changes) / len(elo_changes)) ** 2
-                        for elo in elo_changes
-                    ]
-                )
-                / len(elo_changes)
+                sum([(elo - mean) ** 2 for elo in elo_changes]) / len(elo_changes)
             )
         else:
             results.append(0)
@@ -633,6 +489,8 @@ def get_fatigue_scores(player_name, match_id, matches):
     - The number of games played in the last 7 days
     - The number of games played in the last 30 days
     """
+    if isinstance(matches, PlayerHistory):
+        return matches.get_fatigue_scores(match_id)
 
     # Initialize counts
     last_match_games = 0
@@ -642,6 +500,7 @@ def get_fatigue_scores(player_name, match_id, matches):
 
     # Extract year, tournament from the current match_id
     current_tournament = "_".join(match_id.split("_")[:2])
+    current_day = get_match_day(match_id)
 
     # Sort matches by match_id in descending order
     matches = sorted(matches, key=lambda k: k["match_id"], reverse=True)
@@ -649,31 +508,13 @@ def get_fatigue_scores(player_name, match_id, matches):
     # Iterate through matches in reverse order (most recent first)
     for match in matches:
         if match["match_id"] < match_id:
-            # Check if score is available
-            if not match["score"]:
+            # Skip matches without a score
+            games = get_games(match)
+            if not games:
                 continue
 
-            # Calculate games in match, ignoring tiebreak scores
-            if "_" not in match["score"]:
-                scores = match["score"]
-            else:
-                scores = match["score"].split("_")
-
-            games = sum(
-                (
-                    sum(
-                        int(score[i])
-                        for i in range(min(len(score), 2))
-                        if score[i].isdigit()
-                    )
-                )
-                for score in scores
-            )
-
             # Compare match date to current date
-            match_date = datetime.strptime(match["match_id"][:8], "%Y%m%d")
-            current_date = datetime.strptime(match_id[:8], "%Y%m%d")
-            delta = (current_date - match_date).days
+            delta = current_day - get_day(match)
 
             if delta > 30:
                 break
@@ -694,9 +535,9 @@ def get_fatigue_scores(player_name, match_id, matches):
     return [last_match_games, tournament_games, week_games, month_games]
 
 
-def get_match_stats(match, player_A, player_B, player_A_matches, player_B_matches):
+def get_match_context(match):
     """
-    Calculate match statistics for a given match.
+    One-hot encode the surface, tourney level and round of a match.
     """
     X_dict = {}
 
@@ -728,35 +569,11 @@ def get_match_stats(match, player_A, player_B, player_A_matches, player_B_matche
     ] = 0
     X_dict[match["round"]] = 1
 
-    X_dict["A_previous_elo"] = get_previous_elo(
-        player_A, match["match_id"], player_A_matches
-    )
-    X_dict["B_previous_elo"] = get_previous_elo(
-        player_B, match["match_id"], player_B_matches
-    )
-    X_dict["A_peak_elo"] = get_peak_elo(player_A, match["match_id"], player_A_matches)
-    X_dict["B_peak_elo"] = get_peak_elo(player_B, match["match_id"], player_B_matches)
-    X_dict["A_days_since_debut"] = days_since_debut(
-        player_A, match["match_id"], player_A_matches
-    )
-    X_dict["B_days_since_debut"] = days_since_debut(
-        player_B, match["match_id"], player_B_matches
-    )
+    return X_dict
 
-    (
-        X_dict["A_last_match_games"],
-        X_dict["A_tournament_games"],
-        X_dict["A_week_games"],
-        X_dict["A_month_games"],
-    ) = get_fatigue_scores(player_A, match["match_id"], player_A_matches)
-    (
-        X_dict["B_last_match_games"],
-        X_dict["B_tournament_games"],
-        X_dict["B_week_games"],
-        X_dict["B_month_games"],
-    ) = get_fatigue_scores(player_B, match["match_id"], player_B_matches)
-
-    variance_conditions = [
+
+def get_variance_conditions(match):
+    return [
         {"weeks": 64},
         {"weeks": 256},
         {"weeks": 99999},
@@ -765,30 +582,34 @@ def get_match_stats(match, player_A, player_B, player_A_matches, player_B_matche
         {"round": match["round"]},
     ]
 
-    A_variance_stats = get_elo_variance(
-        player_A, match["match_id"], player_A_matches, variance_conditions
-    )
-    B_variance_stats = get_elo_variance(
-        player_B, match["match_id"], player_B_matches, variance_conditions
-    )
 
-    h2h_stats = get_h2h(
-        [player_A, player_B],
-        match["match_id"],
-        player_A_matches,
-        [
-            {"weeks": 99999},
-            {"weeks": 128},
-            {"weeks": 32},
-            {"surface": match["surface"]},
-            {"surface": match["surface"], "weeks": 128},
-            {"IOC": match["tourney_IOC"]},
-            {"tourney_level": match["tourney_level"]},
-            {"round": match["round"]},
-        ],
-    )
+def get_h2h_conditions(match):
+    return [
+        {"weeks": 99999},
+        {"weeks": 128},
+        {"weeks": 32},
+        {"surface": match["surface"]},
+        {"surface": match["surface"], "weeks": 128},
+        {"IOC": match["tourney_IOC"]},
+        {"tourney_level": match["tourney_level"]},
+        {"round": match["round"]},
+    ]
+
+
+def get_tourney_condition(match):
+    """
+    Condition on the match's tournament. Matches with a tourney_key are compared by
+    key, an integer comparison, and others by their simplified tourney_name.
+    """
+    tourney_key = match.get("tourney_key")
+    if tourney_key is not None and pd.notnull(tourney_key):
+        return {"tourney_key": tourney_key}
+    return {"tourney_name": match["tourney_name"]}
+
 
-    performance_conditions = [
+def get_performance_conditions(match):
+    tourney_condition = get_tourney_condition(match)
+    return [
         {"weeks": 4},
         {"weeks": 8},
         {"weeks": 16},
@@ -808,9 +629,9 @@ def get_match_stats(match, player_A, player_B, player_A_matches, player_B_matche
         {"IOC": match["tourney_IOC"]},
         {"IOC": match["tourney_IOC"], "weeks": 128},
         {"IOC": match["tourney_IOC"], "weeks": 256},
-        {"tourney_name": match["tourney_name"]},
-        {"tourney_name": match["tourney_name"], "weeks": 128},
-        {"tourney_name": match["tourney_name"], "weeks": 256},
+        tourney_condition,
+        {**tourney_condition, "weeks": 128},
+        {**tourney_condition, "weeks": 256},
         {"round": match["round"]},
         {"round": match["round"], "weeks": 128},
         {"round": match["round"], "weeks": 256},
@@ -837,36 +658,112 @@ def get_match_stats(match, player_A, player_B, player_A_matches, player_B_matche
         },
     ]
 
-    A_performance_stats = get_elo_performance(
-        player_A, match["match_id"], player_A_matches, performance_conditions
-    )
-    B_performance_stats = get_elo_performance(
-        player_B, match["match_id"], player_B_matches, performance_conditions
-    )
-    A_win_loss_stats = get_win_loss_record(
-        player_A, match["match_id"], player_A_matches, performance_conditions
-    )
-    B_win_loss_stats = get_win_loss_record(
-        player_B, match["match_id"], player_B_matches, performance_conditions
+
+def get_match_stats(
+    match,
+    player_A,
+    player_B,
+    player_A_matches,
+    player_B_matches,
+    h2h_index=None,
+    selection=None,
+):
+    """
+    Calculate match statistics for a given match. Head-to-head records are read from
+    h2h_index when one is given, instead of scanning player A's matches.
+
+    With a FeatureSelection, only the stats the selection needs are computed and every
+    other stat is left as 0, so the vector keeps the STAT_LABELS layout.
+    """
+    if selection is None:
+        selection = ALL_FEATURES
+    match_id = match["match_id"]
+
+    X_dict = get_match_context(match)
+    X_dict.update(
+        dict.fromkeys(
+            [label for labels in STAT_FAMILIES.values() for label in labels], 0
+        )
     )
 
-    A_win_loss_stats = [stat for stats in A_win_loss_stats for stat in stats]
-    B_win_loss_stats = [stat for stats in B_win_loss_stats for stat in stats]
+    if "previous_elo" in selection.families:
+        X_dict["A_previous_elo"] = get_previous_elo(
+            player_A, match_id, player_A_matches
+        )
+        X_dict["B_previous_elo"] = get_previous_elo(
+            player_B, match_id, player_B_matches
+        )
+    if "peak_elo" in selection.families:
+        X_dict["A_peak_elo"] = get_peak_elo(player_A, match_id, player_A_matches)
+        X_dict["B_peak_elo"] = get_peak_elo(player_B, match_id, player_B_matches)
+    if "days_since_debut" in selection.families:
+        X_dict["A_days_since_debut"] = days_since_debut(
+            player_A, match_id, player_A_matches
+        )
+        X_dict["B_days_since_debut"] = days_since_debut(
+            player_B, match_id, player_B_matches
+        )
+
+    if "fatigue" in selection.families:
+        (
+            X_dict["A_last_match_games"],
+            X_dict["A_tournament_games"],
+            X_dict["A_week_games"],
+            X_dict["A_month_games"],
+        ) = get_fatigue_scores(player_A, match_id, player_A_matches)
+        (
+            X_dict["B_last_match_games"],
+            X_dict["B_tournament_games"],
+            X_dict["B_week_games"],
+            X_dict["B_month_games"],
+        ) = get_fatigue_scores(player_B, match_id, player_B_matches)
+
+    variance_conditions = selection.select("variance", get_variance_conditions(match))
+    A_variance_stats = B_variance_stats = []
+    if variance_conditions:
+        A_variance_stats = get_elo_variance(
+            player_A, match_id, player_A_matches, variance_conditions
+        )
+        B_variance_stats = get_elo_variance(
+            player_B, match_id, player_B_matches, variance_conditions
+        )
+
+    h2h_conditions = selection.select("h2h", get_h2h_conditions(match))
+    h2h_stats = []
+    if h2h_conditions:
+        h2h_stats = get_h2h(
+            [player_A, player_B],
+            match_id,
+            h2h_index if h2h_index is not None else player_A_matches,
+            h2h_conditions,
+        )
+
+    performance_conditions = selection.select(
+        "performance", get_performance_conditions(match)
+    )
+    A_performance_stats = B_performance_stats = []
+    A_win_loss_stats = B_win_loss_stats = []
+    if performance_conditions:
+        A_performance_stats, A_win_loss_stats = get_performance_and_record(
+            player_A, match_id, player_A_matches, performance_conditions
+        )
+        B_performance_stats, B_win_loss_stats = get_performance_and_record(
+            player_B, match_id, player_B_matches, performance_conditions
+        )
 
-    h2h_stats_expanded = []
-    for stats in h2h_stats:
-        for stat in stats:
-            h2h_stats_expanded.append(stat)
+    A_win_loss_stats = selection.expand("performance", A_win_loss_stats, (0, 0))
+    B_win_loss_stats = selection.expand("performance", B_win_loss_stats, (0, 0))
+    h2h_stats = selection.expand("h2h", h2h_stats, (0, 0))
 
     data_list = (
         list(X_dict.values())
-        + A_performance_stats
-        + B_performance_stats
-        + A_win_loss_stats
-        + B_win_loss_stats
-        + h2h_stats_expanded
-        + A_variance_stats
-        + B_variance_stats
+        + selection.expand("performance", A_performance_stats)
+        + selection.expand("performance", B_performance_stats)
+        + [stat for stats in A_win_loss_stats for stat in stats]
+        + [stat for stats in B_win_loss_stats for stat in stats]
+        + [stat for stats in h2h_stats for stat in stats]
+        + selection.expand("variance", A_variance_stats)
+        + selection.expand("variance", B_variance_stats)
     )
 
     return data_list
@@ -0,0 +1,46 @@
+from scripts.data_helpers import simplify_name
+
+
+def create_tournament_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tournaments (
+            tourney_key INTEGER PRIMARY KEY,
+            simplified_name TEXT UNIQUE NOT NULL
+        )
+        """)
+    conn.commit()
+
+
+def get_tourney_keys(conn):
+    """Return {simplified tournament name: tourney_key} for every known tournament."""
+    create_tournament_table(conn)
+    return dict(conn.execute("SELECT simplified_name, tourney_key FROM tournaments"))
+
+
+def add_tourney_keys(conn, tourney_names):
+    """
+    Return the tourney_key of each tournament name, adding the tournaments the table
+    has not seen yet. Names are matched by their simplified form, so spellings that
+    simplify to the same name share a key.
+    """
+    tourney_keys = get_tourney_keys(conn)
+    simplified_names = [
+        simplify_name(name) if name is not None else None for name in tourney_names
+    ]
+
+    new_names = sorted(
+        {
+            name
+            for name in simplified_names
+            if name is not None and name not in tourney_keys
+        }
+    )
+    if new_names:
+        conn.executemany(
+            "INSERT INTO tournaments (simplified_name) VALUES (?)",
+            [(name,) for name in new_names],
+        )
+        conn.commit()
+        tourney_keys = get_tourney_keys(conn)
+
+    return [tourney_keys.get(name) for name in simplified_names]
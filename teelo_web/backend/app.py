@@ -9,6 +9,7 @@ from jellyfish import jaro_winkler_similarity
 import timeit
 from collections import defaultdict
 import datetime
+import threading
 
 import sys
 import os
@@ -20,6 +21,7 @@ parent_dir = os.path.abspath(
 sys.path.append(parent_dir)
 
 from scripts.data_helpers import get_match_date, simplify_name
+from scripts.h2h_index import H2HIndex
 from scripts.stats import get_all_matches_for_player
 
 
@@ -34,6 +36,11 @@ app.config[
 ] = f"sqlite:///{grandparent_dir}/data/matches.sqlite"
 db = SQLAlchemy(app)
 
+# Built on the first head-to-head request and topped up with new matches after that.
+# Requests can be served on several threads, so the index is only used under the lock
+h2h_index = H2HIndex()
+h2h_lock = threading.Lock()
+
 
 class Match(db.Model):
     __tablename__ = "tennis_matches"
@@ -48,6 +55,9 @@ class Match(db.Model):
     round = db.Column(db.String(5), nullable=False)
     A_elo = db.Column(db.Integer, nullable=False)
     B_elo = db.Column(db.Integer, nullable=False)
+    tourney_key = db.Column(db.Integer)
+    A_player_id = db.Column(db.Integer)
+    B_player_id = db.Column(db.Integer)
 
     def serialize(self):
         if self.A_elo == None:
@@ -70,6 +80,28 @@ class Match(db.Model):
         }
 
 
+class Tournament(db.Model):
+    __tablename__ = "tournaments"
+    tourney_key = db.Column(db.Integer, primary_key=True)
+    simplified_name = db.Column(db.String(80), unique=True, nullable=False)
+
+
+class PlayerId(db.Model):
+    __tablename__ = "players"
+    player_id = db.Column(db.Integer, primary_key=True)
+    simplified_name = db.Column(db.String(80), unique=True, nullable=False)
+
+
+class PlayerRating(db.Model):
+    __tablename__ = "player_ratings"
+    player_id = db.Column(db.Integer, primary_key=True)
+    player_name = db.Column(db.String(80), nullable=False)
+    elo = db.Column(db.Float, nullable=False)
+    last_match_id = db.Column(db.String(20), nullable=False)
+    peak_elo = db.Column(db.Float, nullable=False)
+    match_count = db.Column(db.Integer, nullable=False)
+
+
 class Player(db.Model):
     __tablename__ = "player_data"
     player = db.Column(db.String(80), unique=True, nullable=False, primary_key=True)
@@ -95,9 +127,19 @@ def get_matches():
     print(player_name)
     tourney_level = request.args.get("tourney_level")
     surface = request.args.get("surface")
+    tourney_name = request.args.get("tourney_name")
 
     query = Match.query
 
+    if tourney_name:
+        # Tournaments are matched by key, so any spelling of the name finds them
+        tournament = Tournament.query.filter_by(
+            simplified_name=simplify_name(tourney_name)
+        ).first()
+        if tournament is None:
+            return jsonify([])
+        query = query.filter(Match.tourney_key == tournament.tourney_key)
+
     if tourney_level:
         tourney_level = tourney_level.split(",")
         query = query.filter(Match.tourney_level.in_(tourney_level))
@@ -179,30 +221,12 @@ def get_player_rankings():
     # Get current date
     current_date = datetime.datetime.now()
 
-    # Querying matches in descending order of match_id
-    # Only query matches that are in the past 12 months
-    # Convert match id of format YYYYMMDD_XXXX_XXX to datetime object first to compare to current date
-    matches = (
-        Match.query.filter(
-            Match.match_id.like(f"{current_date.year - 1}%")
-            | Match.match_id.like(f"{current_date.year}%")
-        )
-        .order_by(desc(Match.match_id))
-        .all()
-    )
-
-    # Looping through matches to get the most recent ELO for each player
-    rankings = {}
-    for match in matches:
-        if match.A_elo == None:
-            match.A_elo = 1500
-        if match.B_elo == None:
-            match.B_elo = 1500
-
-        if match.A_name not in rankings:
-            rankings[match.A_name] = round(match.A_elo, 0)
-        if match.B_name not in rankings:
-            rankings[match.B_name] = round(match.B_elo, 0)
+    # Each player's current Elo from player_ratings (see create_elo)
+    # Only players with a match this year or last year are ranked
+    ratings = PlayerRating.query.filter(
+        PlayerRating.last_match_id >= str(current_date.year - 1)
+    ).all()
+    rankings = {rating.player_name: round(rating.elo, 0) for rating in ratings}
 
     sorted_rankings = sorted(rankings.items(), key=lambda x: x[1], reverse=True)
 
@@ -218,6 +242,39 @@ def get_player_rankings():
     return sorted_rankings[:num_rankings]
 
 
+@app.route("/get_h2h", methods=["GET"])
+def get_h2h():
+    player_A = request.args.get("player_A")
+    player_B = request.args.get("player_B")
+    if not player_A or not player_B:
+        return jsonify({"error": "player_A and player_B are required"}), 400
+    player_A = simplify_name(player_A)
+    player_B = simplify_name(player_B)
+
+    with h2h_lock:
+        conn = db.engine.raw_connection()
+        try:
+            h2h_index.update_from_db(conn)
+        finally:
+            conn.close()
+
+        meetings = h2h_index.get_meetings(player_A, player_B)
+    for meeting in meetings:
+        meeting["match_date"] = get_match_date(
+            meeting["match_id"], meeting["round"], meeting["tourney_level"]
+        )
+
+    return jsonify(
+        {
+            "player_A": player_A,
+            "player_B": player_B,
+            "player_A_wins": sum(m["winner"] == player_A for m in meetings),
+            "player_B_wins": sum(m["winner"] == player_B for m in meetings),
+            "meetings": meetings,
+        }
+    )
+
+
 @app.route("/get_player_info", methods=["GET"])
 def get_player_stats():
     player_name = request.args.get("player_name")
@@ -230,10 +287,13 @@ def get_player_stats():
 
 
 def get_all_matches_for_player(player_name):
-    player_name = simplify_name(player_name)
+    # Matches are found by player id, an integer comparison
+    player = PlayerId.query.filter_by(simplified_name=simplify_name(player_name)).first()
+    if player is None:
+        return []
     matches = Match.query.filter(
-        (Match.A_simplified_name == player_name)
-        | (Match.B_simplified_name == player_name)
+        (Match.A_player_id == player.player_id)
+        | (Match.B_player_id == player.player_id)
     ).all()
 
     return matches